@@ -0,0 +1,152 @@
+import os
+import sys
+import argparse
+import contextlib
+import copy
+import io
+import json
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"),
+)
+
+import fakes
+import migrate
+from pycti import OpenCTIApiClient
+
+# A page of Stix-Domain-Entities in the format of the OpenCTI 3 GraphQL API
+FIXTURE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "stix_domain_entities.json"
+)
+
+
+def load_nodes(number):
+    with open(FIXTURE) as fixture_handler:
+        edges = json.load(fixture_handler)["data"]["stixDomainEntities"]["edges"]
+    # The entities of the fixture are repeated with their own ids
+    nodes = []
+    for i in range(number):
+        node = copy.deepcopy(edges[i % len(edges)]["node"])
+        node["id"] = str(uuid.UUID(int=i))
+        node["stix_id_key"] = "malware--" + str(uuid.UUID(int=i))
+        nodes.append(node)
+    return nodes
+
+
+class FixtureApiClient(OpenCTIApiClient):
+    def __init__(self, nodes, latency, *args, **kwargs):
+        self.nodes = nodes
+        self.nodes_by_id = {x["id"]: x for x in nodes}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        super().__init__(*args, **kwargs)
+
+    def health_check(self):
+        return True
+
+    def query(self, query, variables={}):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if "stixDomainEntities(" in query:
+            response = self._list(query, variables)
+        else:
+            entity_type = re.search(r"(\w+)\(id: \$id\)", query).group(1)
+            response = {"data": {entity_type: self.nodes_by_id[variables["id"]]}}
+        # Each response is parsed as a response of the API
+        return json.loads(json.dumps(response))
+
+    def _list(self, query, variables):
+        start = int(variables["after"]) if variables.get("after") else 0
+        nodes = self.nodes[start : start + variables["first"]]
+        # Without the fragment of the type, only the listed attributes are returned
+        if "... on Malware" not in query:
+            nodes = [
+                {key: x[key] for key in ["id", "entity_type", "updated_at"]}
+                for x in nodes
+            ]
+        end = start + len(nodes)
+        return {
+            "data": {
+                "stixDomainEntities": {
+                    "edges": [{"node": x} for x in nodes],
+                    "pageInfo": {
+                        "startCursor": str(start),
+                        "endCursor": str(end),
+                        "hasNextPage": end < len(self.nodes),
+                        "hasPreviousPage": start > 0,
+                        "globalCount": len(self.nodes),
+                    },
+                }
+            }
+        }
+
+
+def run(nodes, latency, bulk_export):
+    os.environ.update(fakes.CONFIG)
+    os.environ["OPENCTI_MIGRATION_BULK_EXPORT"] = str(bulk_export).lower()
+    clients = []
+
+    def create_client(*args, **kwargs):
+        clients.append(FixtureApiClient(nodes, latency, *args, **kwargs))
+        return clients[-1]
+
+    broker = fakes.FakeBroker()
+    migrate.OpenCTIApiClient = create_client
+    migrate.pika.BlockingConnection = broker.connect
+    with tempfile.TemporaryDirectory() as directory:
+        migrate.__file__ = os.path.join(directory, "migrate.py")
+        with contextlib.redirect_stdout(io.StringIO()):
+            migration = migrate.Migrate()
+            step, _, list_function, list_arguments, export = migration._steps()[0]
+            started_at = time.monotonic()
+            migration._migrate_step(
+                {"step": step, "after": None, "number": 0},
+                step,
+                list_function,
+                list_arguments,
+                export,
+            )
+            duration = time.monotonic() - started_at
+            migration._close()
+    return clients[0].calls, duration, len(broker.objects())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Step 1 exported by entity and from the listing"
+    )
+    parser.add_argument("--entities", type=int, default=2000)
+    parser.add_argument(
+        "--latency", type=float, default=0.005, help="seconds by API query"
+    )
+    args = parser.parse_args()
+
+    nodes = load_nodes(args.entities)
+    print(
+        "Entities: "
+        + str(args.entities)
+        + ", latency by query: "
+        + str(args.latency * 1000)
+        + " ms"
+    )
+    for title, bulk_export in [("export by entity", False), ("bulk export", True)]:
+        calls, duration, objects = run(nodes, args.latency, bulk_export)
+        print(
+            title
+            + ": "
+            + str(calls)
+            + " API calls, "
+            + "%.2f" % duration
+            + " s, "
+            + str(objects)
+            + " objects sent"
+        )
@@ -0,0 +1,185 @@
+import os
+import sys
+import argparse
+import base64
+import contextlib
+import io
+import json
+import random
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"),
+)
+
+import fakes
+import migrate
+
+
+def report_bundle(randomizer, indicators):
+    # A report with its indicators, as exported from OpenCTI 3
+    author = "identity--" + str(uuid.UUID(int=randomizer.getrandbits(128)))
+    marking = "marking-definition--" + str(uuid.UUID(int=randomizer.getrandbits(128)))
+    objects = [
+        {"id": author, "type": "identity", "name": "CERT", "identity_class": "class"},
+        {
+            "id": marking,
+            "type": "marking-definition",
+            "definition_type": "TLP",
+            "definition": {"TLP": "TLP:AMBER"},
+        },
+    ]
+    for _ in range(indicators):
+        sha256 = "%064x" % randomizer.getrandbits(256)
+        objects.append(
+            {
+                "id": "indicator--" + str(uuid.UUID(int=randomizer.getrandbits(128))),
+                "type": "indicator",
+                "spec_version": "2.1",
+                "name": sha256,
+                "description": " ".join(
+                    randomizer.choice(["dropper", "loader", "stage", "payload", "c2"])
+                    for _ in range(80)
+                ),
+                "pattern": "[file:hashes.'SHA-256' = '" + sha256 + "']",
+                "pattern_type": "stix",
+                "valid_from": "2020-03-02T10:14:31.201Z",
+                "created": "2020-03-02T10:14:31.201Z",
+                "modified": "2020-03-02T10:14:31.201Z",
+                "kill_chain_phases": [
+                    {"kill_chain_name": "mitre-attack", "phase_name": "execution"}
+                ],
+                "external_references": [
+                    {
+                        "source_name": "virustotal",
+                        "url": "https://www.virustotal.com/gui/file/" + sha256,
+                    }
+                ],
+                "x_opencti_score": randomizer.randint(0, 100),
+                "created_by_ref": author,
+                "object_marking_refs": [marking],
+            }
+        )
+    objects.append(
+        {
+            "id": "report--" + str(uuid.UUID(int=randomizer.getrandbits(128))),
+            "type": "report",
+            "name": "Campaign report",
+            "published": "2020-03-02T10:14:31.201Z",
+            "object_refs": [x["id"] for x in objects],
+            "created_by_ref": author,
+            "object_marking_refs": [marking],
+        }
+    )
+    return {"type": "bundle", "objects": objects}
+
+
+def previous_send(channel, bundles, max_objects):
+    # Serialization and encoding replaced by the compact bytes path
+    for bundle in bundles:
+        for i in range(0, len(bundle["objects"]), max_objects):
+            serialized_bundle = (
+                '{"type": "bundle", "objects": ['
+                + ",".join(
+                    json.dumps(x) for x in bundle["objects"][i : i + max_objects]
+                )
+                + "]}"
+            )
+            channel.basic_publish(
+                "",
+                "",
+                json.dumps(
+                    {
+                        "job_id": None,
+                        "applicant_id": None,
+                        "content": base64.b64encode(
+                            serialized_bundle.encode("utf-8")
+                        ).decode("utf-8"),
+                    }
+                ),
+            )
+
+
+def current_send(migration, bundles):
+    for bundle in bundles:
+        migration.bundle_aggregator.add(bundle)
+        migration.bundle_aggregator.flush()
+
+
+def measure(broker, send):
+    broker.messages = []
+    started_at = time.process_time()
+    send()
+    duration = time.process_time() - started_at
+    messages = len(broker.messages)
+    return (
+        sum(len(x) for x in broker.messages) // messages,
+        duration / messages * 1000000,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bytes and CPU by message of the encodings of the bundles"
+    )
+    parser.add_argument("--reports", type=int, default=50)
+    parser.add_argument("--indicators", type=int, default=200)
+    args = parser.parse_args()
+
+    randomizer = random.Random(0)
+    bundles = [report_bundle(randomizer, args.indicators) for _ in range(args.reports)]
+
+    os.environ.update(fakes.CONFIG)
+    api = fakes.FakeApi()
+    broker = fakes.FakeBroker()
+    migrate.OpenCTIApiClient = api.client
+    migrate.pika.BlockingConnection = broker.connect
+    orjson = migrate.orjson
+    with tempfile.TemporaryDirectory() as directory:
+        migrate.__file__ = os.path.join(directory, "migrate.py")
+        with contextlib.redirect_stdout(io.StringIO()):
+            migration = migrate.Migrate()
+        channel = fakes.FakeChannel(broker)
+        max_objects = migration.bundle_aggregator.max_objects
+        print(
+            str(args.reports)
+            + " reports of "
+            + str(args.indicators)
+            + " indicators, messages of "
+            + str(max_objects)
+            + " objects"
+        )
+        variants = [
+            ("previous path", None, "identity"),
+            ("compact json", None, "identity"),
+            ("orjson", orjson, "identity"),
+            ("compact json + gzip", None, "gzip"),
+            ("orjson + gzip", orjson, "gzip"),
+        ]
+        for title, json_backend, content_encoding in variants:
+            if title.startswith("orjson") and orjson is None:
+                print(title + ": orjson is not installed")
+                continue
+            if title == "previous path":
+                message_size, cpu = measure(
+                    broker, lambda: previous_send(channel, bundles, max_objects)
+                )
+            else:
+                migrate.orjson = json_backend
+                migration.content_encoding = content_encoding
+                message_size, cpu = measure(
+                    broker, lambda: current_send(migration, bundles)
+                )
+            print(
+                title
+                + ": "
+                + str(message_size)
+                + " bytes, "
+                + str(int(cpu))
+                + " us of CPU by message"
+            )
+        migration._close()
@@ -0,0 +1,200 @@
+import os
+import sys
+import argparse
+import contextlib
+import copy
+import io
+import json
+import random
+import tempfile
+import time
+import types
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"),
+)
+
+import fakes
+import migrate
+from pycti import OpenCTIApiClient
+from pycti.utils.opencti_stix2 import OpenCTIStix2
+
+
+def stix_observables(randomizer, number):
+    # Observables of a listing, with their authors, markings and indicators
+    creators = [
+        {
+            "id": "creator-" + str(x),
+            "stix_id_key": "identity--" + str(uuid.UUID(int=x)),
+            "entity_type": "organization",
+            "name": "Organization " + str(x),
+            "stix_label": [],
+            "description": "",
+            "alias": [],
+            "created": "2020-01-01T00:00:00.000Z",
+            "modified": "2020-01-01T00:00:00.000Z",
+            "organization_class": "vendor",
+        }
+        for x in range(20)
+    ]
+    markings = [
+        {
+            "id": "marking-" + str(x),
+            "stix_id_key": "marking-definition--" + str(uuid.UUID(int=x)),
+            "definition_type": "TLP",
+            "definition": "TLP:" + ["WHITE", "GREEN", "AMBER", "RED"][x],
+            "created": "2020-01-01T00:00:00.000Z",
+            "modified": "2020-01-01T00:00:00.000Z",
+        }
+        for x in range(4)
+    ]
+    observables = []
+    for x in range(number):
+        observables.append(
+            {
+                "id": "observable-" + str(x),
+                "stix_id_key": "x-opencti-simple-observable--" + str(uuid.UUID(int=x)),
+                "entity_type": "ipv4-addr",
+                "observable_value": "10.%d.%d.%d" % (x >> 16, (x >> 8) & 255, x & 255),
+                "description": "",
+                "created_at": "2020-01-01T00:00:00.000Z",
+                "updated_at": "2020-01-01T00:00:00.000Z",
+                "createdByRef": randomizer.choice(creators + [None]),
+                "markingDefinitions": randomizer.sample(
+                    markings, randomizer.randint(0, 2)
+                ),
+                # Observables with tags keep the export of pycti
+                "tags": (
+                    [{"id": "tag", "tag_type": "type", "value": "tag", "color": "#fff"}]
+                    if x % 50 == 0
+                    else []
+                ),
+                "externalReferences": [],
+                "indicatorsIds": [
+                    "indicator--" + str(uuid.UUID(int=number * 2 + x * 2 + y))
+                    for y in range(randomizer.randint(0, 2))
+                ],
+            }
+        )
+    return observables
+
+
+def previous_export(migration, stix_observable):
+    # Export by observable replaced by the export by page
+    observable_stix = {
+        "id": stix_observable["stix_id_key"],
+        "type": "x-opencti-simple-observable",
+        "key": migrate.OBSERVABLE_KEYS[stix_observable["entity_type"]],
+        "value": stix_observable["observable_value"],
+        "description": stix_observable["description"],
+    }
+    original_bundle_objects = migration.opencti_api_client.stix2.prepare_export(
+        stix_observable, observable_stix
+    )
+    bundle_objects = []
+    for original_bundle_object in original_bundle_objects:
+        if "labels" in original_bundle_object:
+            del original_bundle_object["labels"]
+        bundle_objects.append(original_bundle_object)
+    bundles = [{"type": "bundle", "objects": bundle_objects}]
+    for indicator_id in stix_observable["indicatorsIds"]:
+        relation_stix = {
+            "id": "relationship--" + str(uuid.uuid4()),
+            "type": "relationship",
+            "relationship_type": "based-on",
+            "source_ref": indicator_id,
+            "target_ref": stix_observable["stix_id_key"],
+        }
+        bundles.append({"type": "bundle", "objects": [relation_stix]})
+    return bundles
+
+
+def create_migration(directory):
+    migrate.__file__ = os.path.join(directory, "migrate.py")
+    with contextlib.redirect_stdout(io.StringIO()):
+        migration = migrate.Migrate()
+    # The conversion to STIX2 of pycti, without API
+    migration.opencti_api_client.stix2 = OpenCTIStix2(
+        types.SimpleNamespace(
+            not_empty=lambda value: OpenCTIApiClient.not_empty(None, value),
+            log=lambda *args: None,
+        )
+    )
+    return migration
+
+
+def run(migration, observables, export_page):
+    export_duration = 0
+    duration = 0
+    # Exported and sent a page at a time, as by step 2
+    for page in range(0, len(observables), 100):
+        # The export changes the listed entities
+        entities = copy.deepcopy(observables[page : page + 100])
+        export_started_at = time.perf_counter()
+        page_bundles = export_page(entities)
+        export_duration += time.perf_counter() - export_started_at
+        for bundles in page_bundles:
+            for bundle in bundles:
+                migration.bundle_aggregator.add(bundle)
+        migration.bundle_aggregator.flush()
+        duration += time.perf_counter() - export_started_at
+    return export_duration, duration
+
+
+def objects(broker):
+    # The ids of the based-on relations are random in the previous export
+    return sorted(
+        json.dumps(
+            [x["source_ref"], x["target_ref"]] if x["type"] == "relationship" else x,
+            sort_keys=True,
+        )
+        for x in broker.objects()
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Observables of step 2 exported one by one and by page"
+    )
+    parser.add_argument("--observables", type=int, default=10000)
+    args = parser.parse_args()
+
+    observables = stix_observables(random.Random(0), args.observables)
+
+    os.environ.update(fakes.CONFIG)
+    api = fakes.FakeApi()
+    migrate.OpenCTIApiClient = api.client
+    print(str(args.observables) + " observables, pages of 100")
+    sent_objects = []
+    for title, export_page in [
+        (
+            "export by observable",
+            lambda migration: lambda page: [
+                previous_export(migration, x) for x in page
+            ],
+        ),
+        ("export by page", lambda migration: migration._export_stix_observables),
+    ]:
+        broker = fakes.FakeBroker()
+        migrate.pika.BlockingConnection = broker.connect
+        with tempfile.TemporaryDirectory() as directory:
+            migration = create_migration(directory)
+            export_duration, duration = run(
+                migration, observables, export_page(migration)
+            )
+            migration._close()
+        sent_objects.append(objects(broker))
+        print(
+            title
+            + ": export "
+            + "%.0f" % (export_duration * 1000)
+            + " ms, export and send "
+            + "%.0f" % (duration * 1000)
+            + " ms, "
+            + str(len(broker.messages))
+            + " messages"
+        )
+    print("same objects sent: " + str(sent_objects[0] == sent_objects[1]))
@@ -1,20 +1,253 @@
+import os
+import argparse
+import json
+import threading
+import concurrent.futures
+
 from elasticsearch import Elasticsearch
 
-# ElasticSearch configuration
-elasticsearch_uri = "HOSTNAME:PORT"
+# Indices of the OpenCTI 3 documents which can be connected by a relation
+ENTITY_INDICES = ["stix_domain_entities", "stix_observables", "stix_relations"]
+
+# Number of ids looked up in the entity indices with a single query
+LOOKUP_SIZE = 1000
+
+
+class RelationsCleaner:
+    def __init__(
+        self,
+        client,
+        index="stix_relations",
+        entity_indices=None,
+        slices=4,
+        batch_size=1000,
+        scroll="5m",
+        dry_run=False,
+    ):
+        self.client = client
+        self.index = index
+        self.entity_indices = (
+            entity_indices if entity_indices is not None else ENTITY_INDICES
+        )
+        self.slices = slices
+        self.batch_size = batch_size
+        self.scroll = scroll
+        self.dry_run = dry_run
+        # Ids already looked up, shared by the slices
+        self.lock = threading.Lock()
+        self.existing_ids = set()
+        self.missing_ids = {}
+        self.report = {
+            "dry_run": dry_run,
+            "scanned": 0,
+            "dangling": 0,
+            "deleted": 0,
+            "failed": 0,
+            "relations": [],
+            "errors": [],
+        }
+
+    def _lookup(self, grakn_ids):
+        with self.lock:
+            unknown_ids = [
+                x
+                for x in grakn_ids
+                if x not in self.existing_ids and x not in self.missing_ids
+            ]
+        for i in range(0, len(unknown_ids), LOOKUP_SIZE):
+            chunk = unknown_ids[i : i + LOOKUP_SIZE]
+            # An aggregation returns every existing id once, even if it is duplicated
+            result = self.client.search(
+                index=",".join(self.entity_indices),
+                body={
+                    "size": 0,
+                    "query": {"terms": {"grakn_id.keyword": chunk}},
+                    "aggs": {
+                        "grakn_ids": {
+                            "terms": {"field": "grakn_id.keyword", "size": len(chunk)}
+                        }
+                    },
+                },
+            )
+            existing_ids = set(
+                x["key"] for x in result["aggregations"]["grakn_ids"]["buckets"]
+            )
+            with self.lock:
+                self.existing_ids.update(existing_ids)
+                for grakn_id in chunk:
+                    if grakn_id not in existing_ids:
+                        self.missing_ids.setdefault(grakn_id, 0)
+
+    def _dangling_relations(self, hits):
+        relations = []
+        for hit in hits:
+            connections = hit["_source"].get("connections") or []
+            grakn_ids = [x["grakn_id"] for x in connections if "grakn_id" in x]
+            relations.append((hit, grakn_ids))
+        self._lookup(list(set(x for _, grakn_ids in relations for x in grakn_ids)))
+        dangling_relations = []
+        with self.lock:
+            for hit, grakn_ids in relations:
+                missing_ids = [x for x in grakn_ids if x in self.missing_ids]
+                if len(missing_ids) > 0:
+                    for grakn_id in missing_ids:
+                        self.missing_ids[grakn_id] += 1
+                    dangling_relations.append((hit, missing_ids))
+        return dangling_relations
+
+    def _delete(self, dangling_relations):
+        # A single bulk request for the dangling relations of a batch
+        result = self.client.bulk(
+            body=[
+                {"delete": {"_index": hit["_index"], "_id": hit["_id"]}}
+                for hit, _ in dangling_relations
+            ]
+        )
+        deleted = 0
+        errors = []
+        for item in result["items"]:
+            status = item["delete"]["status"]
+            # A relation already deleted is not an error
+            if status < 300 or status == 404:
+                deleted += 1
+            else:
+                errors.append(
+                    {"id": item["delete"]["_id"], "error": item["delete"].get("error")}
+                )
+        return deleted, errors
+
+    def _process(self, hits):
+        dangling_relations = self._dangling_relations(hits)
+        deleted, errors = 0, []
+        if len(dangling_relations) > 0 and not self.dry_run:
+            deleted, errors = self._delete(dangling_relations)
+        with self.lock:
+            self.report["scanned"] += len(hits)
+            self.report["dangling"] += len(dangling_relations)
+            self.report["deleted"] += deleted
+            self.report["failed"] += len(errors)
+            self.report["errors"].extend(errors)
+            self.report["relations"].extend(
+                {"id": hit["_id"], "missing_ids": missing_ids}
+                for hit, missing_ids in dangling_relations
+            )
+
+    def _scan_slice(self, slice_id):
+        body = {
+            "size": self.batch_size,
+            "query": {"match_all": {}},
+            "_source": ["connections.grakn_id"],
+            "sort": ["_doc"],
+        }
+        # The slices split the scroll of the index between the threads
+        if self.slices > 1:
+            body["slice"] = {"id": slice_id, "max": self.slices}
+        result = self.client.search(index=self.index, body=body, scroll=self.scroll)
+        scroll_id = result.get("_scroll_id")
+        try:
+            # The scroll reads a snapshot of the index, not affected by the deletes
+            while len(result["hits"]["hits"]) > 0:
+                self._process(result["hits"]["hits"])
+                result = self.client.scroll(scroll_id=scroll_id, scroll=self.scroll)
+                scroll_id = result.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id is not None:
+                self.client.clear_scroll(scroll_id=scroll_id)
+
+    def run(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.slices) as executor:
+            for future in [
+                executor.submit(self._scan_slice, slice_id)
+                for slice_id in range(self.slices)
+            ]:
+                future.result()
+        self.report["missing_ids"] = dict(
+            sorted(self.missing_ids.items(), key=lambda x: -x[1])
+        )
+        return self.report
+
 
-# ID to remove
-id_to_clean = "V1208520904"  # to be replace by the missing ID
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Delete the OpenCTI 3 relations connected to a missing entity"
+    )
+    parser.add_argument(
+        "--elasticsearch-uri",
+        action="append",
+        help="ElasticSearch of the OpenCTI 3 instance (default: "
+        "OPENCTI_V3_ELASTICSEARCH_URI or localhost:9200), can be repeated",
+    )
+    parser.add_argument(
+        "--index",
+        default="stix_relations",
+        help="index of the relations (default: stix_relations)",
+    )
+    parser.add_argument(
+        "--entity-index",
+        action="append",
+        help="index of the connected documents, can be repeated (default: "
+        + ", ".join(ENTITY_INDICES)
+        + ")",
+    )
+    parser.add_argument(
+        "--slices",
+        type=int,
+        default=4,
+        help="number of slices of the scroll scanned in parallel (default: 4)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="relations read by scroll request and deleted by bulk request "
+        "(default: 1000)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the relations to delete",
+    )
+    parser.add_argument(
+        "--report",
+        default="clear_relations_report.json",
+        help="file of the report (default: clear_relations_report.json)",
+    )
+    args = parser.parse_args()
 
-print("[INITIALIZE] ElasticSearch connected")
-elasticsearch_client = Elasticsearch([elasticsearch_uri])
+    elasticsearch_uris = args.elasticsearch_uri or [
+        os.environ.get("OPENCTI_V3_ELASTICSEARCH_URI", "localhost:9200")
+    ]
+    print("[INITIALIZE] ElasticSearch connected")
+    elasticsearch_client = Elasticsearch(
+        elasticsearch_uris, timeout=60, max_retries=5, retry_on_timeout=True
+    )
 
-print("[QUERY] ElasticSearch match " + id_to_clean)
-query = {
-    "size": 10000,
-    "query": {"match_phrase": {"connections.grakn_id.keyword": id_to_clean}},
-}
-# result = elasticsearch_client.search(index="stix_relations", body=query)
-result = elasticsearch_client.delete_by_query(index="stix_relations", body=query)
+    print(
+        "[QUERY] ElasticSearch scan of "
+        + args.index
+        + (" (dry run)" if args.dry_run else "")
+    )
+    report = RelationsCleaner(
+        elasticsearch_client,
+        args.index,
+        args.entity_index,
+        args.slices,
+        args.batch_size,
+        dry_run=args.dry_run,
+    ).run()
+    with open(args.report, "w") as report_file_handler:
+        json.dump(report, report_file_handler, indent=2)
 
-print(result)
+    print(
+        "Relations scanned: "
+        + str(report["scanned"])
+        + ", dangling: "
+        + str(report["dangling"])
+        + ", deleted: "
+        + str(report["deleted"])
+        + ", failed: "
+        + str(report["failed"])
+        + ", missing ids: "
+        + str(len(report["missing_ids"]))
+    )
+    print("Report written in " + args.report)
@@ -1,16 +1,36 @@
 import os
+import argparse
+import sys
 import yaml
 import pika
 import json
-import base64
+import binascii
+import hashlib
+import zlib
+import gzip
 import logging
-import copy
+import collections
 import uuid
 import progressbar
+import dateutil.parser
+import multiprocessing
+import queue
+import sqlite3
+import threading
+import time
+import concurrent.futures
+import contextlib
+import datetime
+import http.server
 
 from art import *
 from pycti import OpenCTIApiClient
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 mandatory_configs = [
     "opencti_v3_url",
     "opencti_v3_token",
@@ -45,9 +65,1284 @@ OBSERVABLE_KEYS = {
     "cryptocurrency-wallet": "X-OpenCTI-Cryptocurrency-Wallet.value",
 }
 
+# GraphQL type and API entity of the Stix-Domain-Entities converted from their listing
+BULK_EXPORT_TYPES = {
+    "sector": ("Identity", "identity"),
+    "region": ("Identity", "identity"),
+    "country": ("Identity", "identity"),
+    "city": ("Identity", "identity"),
+    "organization": ("Identity", "identity"),
+    "user": ("Identity", "identity"),
+    "threat-actor": ("ThreatActor", "threat_actor"),
+    "intrusion-set": ("IntrusionSet", "intrusion_set"),
+    "campaign": ("Campaign", "campaign"),
+    "incident": ("Incident", "incident"),
+    "malware": ("Malware", "malware"),
+    "tool": ("Tool", "tool"),
+    "vulnerability": ("Vulnerability", "vulnerability"),
+    "attack-pattern": ("AttackPattern", "attack_pattern"),
+    "course-of-action": ("CourseOfAction", "course_of_action"),
+    "indicator": ("Indicator", "indicator"),
+    "opinion": ("Opinion", "opinion"),
+    "report": ("Report", "report"),
+    "note": ("Note", "note"),
+}
+
+# Namespace of the ids of the based-on relations generated for the observables
+BASED_ON_NAMESPACE = uuid.UUID("74c6969d-c25f-4756-a471-538f06c4445c")
+
+# Namespace of the ids of the parts of the observed data of a split container
+OBSERVED_DATA_NAMESPACE = uuid.UUID("4e5e938a-75fa-4280-bc22-65dd062a72ba")
+
+# Types of the objects embedded again and again in the exported bundles
+SHARED_REFERENCE_TYPES = ["identity", "marking-definition"]
+
+# Message of the import connector around the base64 content of a bundle
+MESSAGE_PREFIX = b'{"job_id":null,"applicant_id":null,"content":"'
+MESSAGE_SUFFIX = b'"}'
+GZIP_MESSAGE_PREFIX = (
+    b'{"job_id":null,"applicant_id":null,"content_encoding":"gzip","content":"'
+)
+
+
+def json_dumps(data):
+    # Compact JSON in UTF-8, serialized by orjson when it is installed
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            pass
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class PipelineStage(threading.Thread):
+    def __init__(self, target, stop):
+        super().__init__(daemon=True)
+        self.target = target
+        self.stop = stop
+        self.error = None
+
+    def run(self):
+        try:
+            self.target()
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            self.error = e
+            self.stop.set()
+
+
+def queue_put(stage_queue, item, stop):
+    while not stop.is_set():
+        try:
+            stage_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+    raise PipelineStopped()
+
+
+def queue_get(stage_queue, stop):
+    while not stop.is_set():
+        try:
+            return stage_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+    raise PipelineStopped()
+
+
+class SeenObjects:
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.memory = 0
+        self.ids = collections.OrderedDict()
+        self.added = set()
+        self.evicted = set()
+
+    def _entry_memory(self, object_id):
+        # Approximate memory of the id and of its entry in the ordered dict
+        return sys.getsizeof(object_id) + 100
+
+    def load(self, ids):
+        for object_id in ids:
+            self.ids[object_id] = True
+            self.memory += self._entry_memory(object_id)
+
+    def __contains__(self, object_id):
+        if object_id in self.ids:
+            self.ids.move_to_end(object_id)
+            return True
+        return False
+
+    def add(self, object_id):
+        if object_id in self.ids:
+            self.ids.move_to_end(object_id)
+            return
+        self.ids[object_id] = True
+        self.memory += self._entry_memory(object_id)
+        self.added.add(object_id)
+        self.evicted.discard(object_id)
+        # The least recently used ids are evicted beyond the memory budget
+        while self.memory > self.max_memory and len(self.ids) > 0:
+            evicted_id, _ = self.ids.popitem(last=False)
+            self.memory -= self._entry_memory(evicted_id)
+            self.added.discard(evicted_id)
+            self.evicted.add(evicted_id)
+
+    def pop_changes(self):
+        changes = (self.added, self.evicted)
+        self.added = set()
+        self.evicted = set()
+        return changes
+
+
+class BundleAggregator:
+    def __init__(
+        self, send, max_objects, max_size, seen_objects=None, published_objects=None
+    ):
+        self.send = send
+        self.seen_objects = seen_objects
+        self.published_objects = published_objects
+        self.max_objects = max_objects
+        self.max_size = max_size
+        self.objects = []
+        self.size = 0
+        self.page_ids = set()
+        self.messages_sent = 0
+        self.objects_sent = 0
+        self.objects_skipped = 0
+        self.digests = []
+        # The serialization of the objects of a message is part of its encoding
+        self.serialize_duration = 0.0
+        # Entities are published once their message and all the previous ones are confirmed
+        self.lock = threading.Lock()
+        self.entity_ids = []
+        self.message_entity_ids = {}
+        self.confirmed_messages = set()
+        self.next_confirmed_message = 1
+        self.published_ids = []
+        self.message_digests = {}
+        self.published_digests = []
+
+    def add(self, bundle):
+        for bundle_object in bundle["objects"]:
+            # Objects already sent in the current page are not sent again, except the
+            # exported entity itself, sent in chunks when it is a large container
+            if (
+                bundle_object["id"] in self.page_ids
+                and bundle_object is not bundle["objects"][-1]
+            ):
+                continue
+            self.page_ids.add(bundle_object["id"])
+            # The authors and markings already sent are only referenced by their id,
+            # the exported entity itself is always the last object of its bundle
+            if (
+                self.seen_objects is not None
+                and bundle_object["type"] in SHARED_REFERENCE_TYPES
+            ):
+                if (
+                    bundle_object is not bundle["objects"][-1]
+                    and bundle_object["id"] in self.seen_objects
+                ):
+                    continue
+                self.seen_objects.add(bundle_object["id"])
+            started_at = time.perf_counter()
+            serialized_object = json_dumps(bundle_object)
+            serialize_duration = time.perf_counter() - started_at
+            # Objects confirmed by a previous run are not sent again, unless changed
+            digest = None
+            if self.published_objects is not None:
+                digest = PublishedObjects.digest(serialized_object)
+                if digest in self.published_objects:
+                    self.objects_skipped += 1
+                    self.serialize_duration += serialize_duration
+                    continue
+            if len(self.objects) > 0 and (
+                len(self.objects) >= self.max_objects
+                or self.size + len(serialized_object) > self.max_size
+            ):
+                self._send()
+            self.serialize_duration += serialize_duration
+            if digest is not None:
+                self.digests.append(digest)
+            self.objects.append(serialized_object)
+            self.size += len(serialized_object) + 1
+
+    def mark(self, entity_id):
+        self.entity_ids.append(entity_id)
+
+    def flush(self):
+        if len(self.objects) > 0:
+            self._send()
+        self.page_ids = set()
+        self.entity_ids = []
+
+    def pop_published_ids(self):
+        with self.lock:
+            published_ids = self.published_ids
+            self.published_ids = []
+        return published_ids
+
+    def pop_published_digests(self):
+        with self.lock:
+            published_digests = self.published_digests
+            self.published_digests = []
+        return published_digests
+
+    def _send(self):
+        self.messages_sent += 1
+        message_number = self.messages_sent
+        with self.lock:
+            self.message_entity_ids[message_number] = self.entity_ids
+            self.message_digests[message_number] = self.digests
+        self.entity_ids = []
+        self.digests = []
+        self.send(
+            b'{"type":"bundle","objects":[' + b",".join(self.objects) + b"]}",
+            lambda: self._on_confirm(message_number),
+            self.serialize_duration,
+        )
+        self.objects_sent += len(self.objects)
+        self.objects = []
+        self.serialize_duration = 0.0
+        self.size = 0
+
+    def _on_confirm(self, message_number):
+        with self.lock:
+            self.confirmed_messages.add(message_number)
+            while self.next_confirmed_message in self.confirmed_messages:
+                self.confirmed_messages.remove(self.next_confirmed_message)
+                self.published_ids.extend(
+                    self.message_entity_ids.pop(self.next_confirmed_message)
+                )
+                self.published_digests.extend(
+                    self.message_digests.pop(self.next_confirmed_message)
+                )
+                self.next_confirmed_message += 1
+
+
+class RabbitMQPublisher:
+    def __init__(self, parameters, exchange, routing_key):
+        self.parameters = parameters
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.connection = None
+        self.channel = None
+        self.reconnects = 0
+        self.retries = 0
+        self.connect()
+
+    def connect(self):
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+
+    def publish(self, body, callback=None, retry=False):
+        try:
+            self.channel.basic_publish(
+                exchange=self.exchange,
+                routing_key=self.routing_key,
+                body=body,
+                properties=pika.BasicProperties(
+                    delivery_mode=2,  # make message persistent
+                ),
+            )
+        except:
+            if retry is False:
+                self.reconnects += 1
+                self.retries += 1
+                self.connect()
+                self.publish(body, callback, True)
+                return
+            else:
+                raise ValueError("Impossible to send a message to RabbitMQ")
+        if callback is not None:
+            callback()
+
+    def wait_for_confirms(self):
+        pass
+
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+
+
+class RabbitMQConfirmPublisher:
+    def __init__(self, parameters, exchange, routing_key, window, timeout, max_retries):
+        self.parameters = parameters
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.window = window
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        # Messages not confirmed yet, by delivery tag of the current channel
+        self.unconfirmed = {}
+        # Messages waiting for the channel to be reopened
+        self.waiting = collections.deque()
+        self.in_flight = 0
+        self.delivery_tag = 0
+        self.error = None
+        self.closing = False
+        self.reconnects = 0
+        self.retries = 0
+        self.connection = None
+        self.channel = None
+        self.ready = threading.Event()
+        self.ioloop = pika.SelectConnection.create_default_ioloop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ioloop.add_callback_threadsafe(self._connect)
+        self.ready.wait(timeout)
+        if not self.ready.is_set():
+            self._check_error()
+            raise ValueError("Impossible to connect to RabbitMQ")
+
+    def _run(self):
+        self.ioloop.start()
+
+    def _connect(self):
+        self.connection = pika.SelectConnection(
+            self.parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_closed,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.ioloop,
+        )
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        self.delivery_tag = 0
+        channel.confirm_delivery(ack_nack_callback=self._on_delivery_confirmation)
+        # Messages sent on a previous channel are sent again on this one
+        with self.condition:
+            messages = [self.unconfirmed[x] for x in sorted(self.unconfirmed)]
+            messages.extend(self.waiting)
+            self.unconfirmed = {}
+            self.waiting.clear()
+        for body, _, attempt, callback in messages:
+            self._publish(body, attempt, callback)
+        self.ready.set()
+        self.ioloop.call_later(1, self._check_timeouts)
+
+    def _on_connection_closed(self, connection, error):
+        self.channel = None
+        if self.closing:
+            self.ioloop.stop()
+            return
+        self.reconnects += 1
+        if self.reconnects > self.max_retries and not self.ready.is_set():
+            with self.condition:
+                self.error = ValueError("Impossible to connect to RabbitMQ")
+                self.condition.notify_all()
+            self.ioloop.stop()
+            return
+        self.ioloop.call_later(self._backoff(min(self.reconnects, 5)), self._connect)
+
+    def _backoff(self, attempt):
+        return min(0.5 * 2**attempt, 30)
+
+    def _publish(self, body, attempt, callback):
+        if self.channel is None or not self.channel.is_open:
+            with self.condition:
+                self.waiting.append((body, None, attempt, callback))
+            return
+        self.delivery_tag += 1
+        with self.condition:
+            self.unconfirmed[self.delivery_tag] = (
+                body,
+                time.monotonic(),
+                attempt,
+                callback,
+            )
+        self.channel.basic_publish(
+            exchange=self.exchange,
+            routing_key=self.routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,  # make message persistent
+            ),
+        )
+
+    def _on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        with self.condition:
+            if method.multiple:
+                delivery_tags = [
+                    x for x in self.unconfirmed if 0 < x <= method.delivery_tag
+                ]
+            else:
+                delivery_tags = [method.delivery_tag]
+            messages = [
+                self.unconfirmed.pop(x) for x in delivery_tags if x in self.unconfirmed
+            ]
+            if isinstance(method, pika.spec.Basic.Ack):
+                for _, _, _, callback in messages:
+                    if callback is not None:
+                        callback()
+                self.in_flight -= len(messages)
+                self.condition.notify_all()
+                return
+        for message in messages:
+            self._retry(message)
+
+    def _check_timeouts(self):
+        if self.channel is None:
+            return
+        now = time.monotonic()
+        with self.condition:
+            delivery_tags = [
+                x
+                for x, (_, sent_at, _, _) in self.unconfirmed.items()
+                if now - sent_at > self.timeout
+            ]
+            messages = [self.unconfirmed.pop(x) for x in delivery_tags]
+        for message in messages:
+            self._retry(message)
+        self.ioloop.call_later(1, self._check_timeouts)
+
+    def _retry(self, message):
+        body, _, attempt, callback = message
+        if attempt >= self.max_retries:
+            with self.condition:
+                self.error = ValueError("Impossible to send a message to RabbitMQ")
+                self.condition.notify_all()
+            return
+        self.retries += 1
+        self.ioloop.call_later(
+            self._backoff(attempt), lambda: self._publish(body, attempt + 1, callback)
+        )
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def publish(self, body, callback=None):
+        with self.condition:
+            while self.in_flight >= self.window and self.error is None:
+                self.condition.wait(1)
+            self._check_error()
+            self.in_flight += 1
+        self.ioloop.add_callback_threadsafe(lambda: self._publish(body, 0, callback))
+
+    def wait_for_confirms(self):
+        with self.condition:
+            while self.in_flight > 0 and self.error is None:
+                self.condition.wait(1)
+            self._check_error()
+
+    def close(self):
+        self.closing = True
+        if self.connection is not None:
+            self.ioloop.add_callback_threadsafe(self.connection.close)
+        self.thread.join(self.timeout)
+
+
+class Metrics:
+    # Upper bounds in seconds of the buckets of the latency histograms
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60]
+    OPERATIONS = ["list", "export", "transform", "encode", "publish", "confirm"]
+    COUNTERS = [
+        "entities",
+        "entities_skipped",
+        "objects",
+        "objects_skipped",
+        "messages",
+        "bytes",
+    ]
 
-class Migrate:
     def __init__(self):
+        self.lock = threading.Lock()
+        self.step = None
+        self.publisher = None
+        # Histograms and counters by step, the step being the current one
+        self.histograms = {}
+        self.counters = {}
+        self.started_at = {}
+
+    def begin_step(self, step):
+        with self.lock:
+            self.step = step
+            self.started_at.setdefault(step, time.time())
+
+    def observe(self, operation, seconds):
+        with self.lock:
+            histogram = self.histograms.get((operation, self.step))
+            if histogram is None:
+                histogram = {"buckets": [0] * (len(self.BUCKETS) + 1), "sum": 0.0}
+                self.histograms[(operation, self.step)] = histogram
+            index = 0
+            while index < len(self.BUCKETS) and seconds > self.BUCKETS[index]:
+                index += 1
+            histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+
+    @contextlib.contextmanager
+    def time(self, operation):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - started_at)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            key = (name, self.step)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get((name, self.step), 0)
+
+    def _publisher_counters(self):
+        return {
+            "retries": getattr(self.publisher, "retries", 0),
+            "reconnects": getattr(self.publisher, "reconnects", 0),
+        }
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append(
+                "# TYPE opencti_migration_operation_duration_seconds histogram"
+            )
+            for (operation, step), histogram in sorted(
+                self.histograms.items(), key=lambda x: (x[0][0], str(x[0][1]))
+            ):
+                labels = 'operation="' + operation + '",step="' + str(step) + '"'
+                cumulative = 0
+                for bound, number in zip(self.BUCKETS + ["+Inf"], histogram["buckets"]):
+                    cumulative += number
+                    lines.append(
+                        "opencti_migration_operation_duration_seconds_bucket{"
+                        + labels
+                        + ',le="'
+                        + str(bound)
+                        + '"} '
+                        + str(cumulative)
+                    )
+                lines.append(
+                    "opencti_migration_operation_duration_seconds_sum{"
+                    + labels
+                    + "} "
+                    + repr(histogram["sum"])
+                )
+                lines.append(
+                    "opencti_migration_operation_duration_seconds_count{"
+                    + labels
+                    + "} "
+                    + str(cumulative)
+                )
+            for name in self.COUNTERS:
+                lines.append("# TYPE opencti_migration_" + name + "_total counter")
+                for (counter, step), value in sorted(
+                    self.counters.items(), key=lambda x: str(x[0][1])
+                ):
+                    if counter == name:
+                        lines.append(
+                            "opencti_migration_"
+                            + name
+                            + '_total{step="'
+                            + str(step)
+                            + '"} '
+                            + str(value)
+                        )
+        for name, value in self._publisher_counters().items():
+            lines.append("# TYPE opencti_migration_" + name + "_total counter")
+            lines.append("opencti_migration_" + name + "_total " + str(value))
+        return "\n".join(lines) + "\n"
+
+    def _quantile(self, histogram, quantile):
+        # The quantiles are estimated with the upper bound of their bucket
+        total = sum(histogram["buckets"])
+        cumulative = 0
+        for bound, number in zip(self.BUCKETS + [None], histogram["buckets"]):
+            cumulative += number
+            if cumulative >= quantile * total:
+                return bound
+        return None
+
+    def report(self, step):
+        ended_at = time.time()
+        with self.lock:
+            started_at = self.started_at.get(step, ended_at)
+            duration = max(ended_at - started_at, 0.001)
+            report = {
+                "step": step,
+                "started_at": datetime.datetime.fromtimestamp(
+                    started_at, datetime.timezone.utc
+                ).isoformat(),
+                "ended_at": datetime.datetime.fromtimestamp(
+                    ended_at, datetime.timezone.utc
+                ).isoformat(),
+                "duration": duration,
+            }
+            for name in self.COUNTERS:
+                report[name] = self.counters.get((name, step), 0)
+            report["objects_per_second"] = report["objects"] / duration
+            report["bytes_per_second"] = report["bytes"] / duration
+            report["latencies"] = {}
+            for operation in self.OPERATIONS:
+                histogram = self.histograms.get((operation, step))
+                if histogram is None:
+                    continue
+                count = sum(histogram["buckets"])
+                report["latencies"][operation] = {
+                    "count": count,
+                    "sum": histogram["sum"],
+                    "mean": histogram["sum"] / count,
+                    "p50": self._quantile(histogram, 0.5),
+                    "p95": self._quantile(histogram, 0.95),
+                    "p99": self._quantile(histogram, 0.99),
+                }
+        report.update(self._publisher_counters())
+        return report
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FlowController:
+    def __init__(
+        self,
+        parameters,
+        queue_name,
+        low_watermark,
+        high_watermark,
+        interval,
+        initial_rate,
+        rate_increase,
+    ):
+        self.parameters = parameters
+        self.queue_name = queue_name
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.interval = interval
+        self.rate = float(initial_rate)
+        self.rate_increase = rate_increase
+        self.connection = None
+        self.channel = None
+        self.depth = None
+        self.checked_at = None
+        self.next_send = time.monotonic()
+        self.sent = 0
+        self.effective_rate = 0.0
+
+    def _queue_depth(self):
+        # The depth is read on a dedicated connection, not on the publishing one
+        try:
+            if self.connection is None or not self.connection.is_open:
+                self.connection = pika.BlockingConnection(self.parameters)
+            if self.channel is None or not self.channel.is_open:
+                self.channel = self.connection.channel()
+            return self.channel.queue_declare(
+                queue=self.queue_name, passive=True
+            ).method.message_count
+        except Exception as e:
+            logging.warning("Impossible to read the depth of the queue: " + str(e))
+            self.channel = None
+            return None
+
+    def _check(self):
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.interval:
+            return
+        if self.checked_at is not None:
+            self.effective_rate = self.sent / (now - self.checked_at)
+        self.checked_at = now
+        self.sent = 0
+        self.depth = self._queue_depth()
+        if self.depth is None:
+            return
+        if self.depth > self.high_watermark:
+            # Multiplicative decrease, and no publication until the workers catch up
+            self.rate = max(self.rate / 2, 1.0)
+            while self.depth is not None and self.depth > self.high_watermark:
+                time.sleep(self.interval)
+                self.depth = self._queue_depth()
+            self.checked_at = time.monotonic()
+            self.next_send = self.checked_at
+        elif self.depth < self.low_watermark and self.effective_rate >= self.rate * 0.9:
+            # Additive increase, only when the current rate is actually reached
+            self.rate += self.rate_increase
+
+    def throttle(self):
+        self._check()
+        now = time.monotonic()
+        if self.next_send > now:
+            time.sleep(self.next_send - now)
+        self.next_send = max(self.next_send, now) + 1 / self.rate
+        self.sent += 1
+
+    def describe(self):
+        return "%.1f msg/s (limit %.1f msg/s, queue %s)" % (
+            self.effective_rate,
+            self.rate,
+            "-" if self.depth is None else str(self.depth),
+        )
+
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+
+
+class CheckpointStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # The write-ahead log keeps the store consistent on a crash with cheap commits
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints "
+                "(partition TEXT PRIMARY KEY, state TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS seen_objects "
+                "(partition TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (partition, id))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS published "
+                "(partition TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (partition, id)) "
+                "WITHOUT ROWID"
+            )
+
+    def get_state(self, partition):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT state FROM checkpoints WHERE partition = ?", (partition,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_state(self, partition, state):
+        # The entities published in the current page are forgotten with the new cursor
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints (partition, state) VALUES (?, ?)",
+                (partition, json.dumps(state)),
+            )
+            self.connection.execute(
+                "DELETE FROM published WHERE partition = ?", (partition,)
+            )
+        return state
+
+    def get_published(self, partition):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id FROM published WHERE partition = ?", (partition,)
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def get_seen_objects(self, partition):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id FROM seen_objects WHERE partition = ? ORDER BY rowid",
+                (partition,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def update_seen_objects(self, partition, added, evicted):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO seen_objects (partition, id) VALUES (?, ?)",
+                [(partition, x) for x in added],
+            )
+            self.connection.executemany(
+                "DELETE FROM seen_objects WHERE partition = ? AND id = ?",
+                [(partition, x) for x in evicted],
+            )
+
+    def add_published(self, partition, ids):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO published (partition, id) VALUES (?, ?)",
+                [(partition, x) for x in ids],
+            )
+
+
+class PublishedObjects:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # Sorted index of the digests of the confirmed objects, shared by all the runs
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS published_objects "
+                "(digest BLOB PRIMARY KEY) WITHOUT ROWID"
+            )
+
+    @staticmethod
+    def digest(serialized_object):
+        # The id and the content of an object, so an updated object is sent again
+        return hashlib.blake2b(serialized_object, digest_size=16).digest()
+
+    def __contains__(self, digest):
+        with self.lock:
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM published_objects WHERE digest = ?", (digest,)
+                ).fetchone()
+                is not None
+            )
+
+    def add(self, digests):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO published_objects (digest) VALUES (?)",
+                [(x,) for x in digests],
+            )
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM published_objects"
+            ).fetchone()[0]
+
+
+class DeferredRelations:
+    def __init__(self, store, scope):
+        # The relations emitted by a migration and by a publication of the cache are
+        # ordered separately
+        self.scope = scope
+        # The changes of a page are committed with its state, in the checkpoint store
+        self.lock = store.lock
+        self.connection = store.connection
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS emitted_relations "
+                "(scope TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (scope, id)) "
+                "WITHOUT ROWID"
+            )
+            # The relations waiting for another relation are kept on disk
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS deferred_relations "
+                "(scope TEXT NOT NULL, id TEXT NOT NULL, dependencies TEXT NOT NULL, "
+                "bundles TEXT NOT NULL, PRIMARY KEY (scope, id))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS deferred_dependencies "
+                "(scope TEXT NOT NULL, dependency TEXT NOT NULL, id TEXT NOT NULL, "
+                "PRIMARY KEY (scope, dependency, id)) WITHOUT ROWID"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS deferred_dependencies_id "
+                "ON deferred_dependencies (scope, id)"
+            )
+        # Changes of the current page, kept in memory until the page is confirmed
+        self.emitted = set()
+        self.deferred = {}
+        self.released = set()
+
+    @staticmethod
+    def dependencies(bundles):
+        # The relationship is the last object of its bundle
+        if len(bundles) == 0 or len(bundles[-1]["objects"]) == 0:
+            return None, []
+        relation = bundles[-1]["objects"][-1]
+        return relation["id"], [
+            relation[x]
+            for x in ["source_ref", "target_ref"]
+            if relation.get(x, "").startswith("relationship--")
+        ]
+
+    def _is_emitted(self, relation_id):
+        return relation_id in self.emitted or (
+            self.connection.execute(
+                "SELECT 1 FROM emitted_relations WHERE scope = ? AND id = ?",
+                (self.scope, relation_id),
+            ).fetchone()
+            is not None
+        )
+
+    def _emit(self, relation_id):
+        self.emitted.add(relation_id)
+
+    def order(self, bundles):
+        relation_id, dependencies = self.dependencies(bundles)
+        if relation_id is None:
+            return bundles
+        with self.lock:
+            waiting = [x for x in dependencies if not self._is_emitted(x)]
+            if len(waiting) > 0:
+                self.deferred[relation_id] = (dependencies, waiting, bundles)
+                return []
+            # The relations waiting for this one follow it, in dependency order
+            result = list(bundles)
+            self._emit(relation_id)
+            emitted = collections.deque([relation_id])
+            while len(emitted) > 0:
+                dependency = emitted.popleft()
+                rows = [
+                    (x[0], json.loads(x[1]), json.loads(x[2]))
+                    for x in self.connection.execute(
+                        "SELECT r.id, r.dependencies, r.bundles "
+                        "FROM deferred_dependencies d "
+                        "JOIN deferred_relations r ON r.scope = d.scope AND r.id = d.id "
+                        "WHERE d.scope = ? AND d.dependency = ?",
+                        (self.scope, dependency),
+                    ).fetchall()
+                ]
+                rows.extend(
+                    (x, y[0], y[2])
+                    for x, y in self.deferred.items()
+                    if dependency in y[1]
+                )
+                for dependent_id, dependent_dependencies, dependent_bundles in rows:
+                    if self._is_emitted(dependent_id) or not all(
+                        self._is_emitted(x) for x in dependent_dependencies
+                    ):
+                        continue
+                    result.extend(dependent_bundles)
+                    self._emit(dependent_id)
+                    # A relation deferred in this page is never written
+                    if self.deferred.pop(dependent_id, None) is None:
+                        self.released.add(dependent_id)
+                    emitted.append(dependent_id)
+            return result
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM deferred_relations WHERE scope = ?",
+                (self.scope,),
+            ).fetchone()[0]
+
+    def drain(self, size):
+        with self.lock:
+            # Relations not waiting for another deferred relation go first
+            rows = self.connection.execute(
+                "SELECT r.id, r.bundles FROM deferred_relations r "
+                "WHERE r.scope = ? AND NOT EXISTS (SELECT 1 FROM deferred_dependencies d "
+                "JOIN deferred_relations p ON p.scope = d.scope AND p.id = d.dependency "
+                "WHERE d.scope = r.scope AND d.id = r.id) ORDER BY r.rowid LIMIT ?",
+                (self.scope, size),
+            ).fetchall()
+            if len(rows) == 0:
+                # Only cycles are left, one of them is broken by sending a relation on it
+                rows = self._cycle_relation()
+            for relation_id, _ in rows:
+                self._emit(relation_id)
+                self.released.add(relation_id)
+        return [(x[0], json.loads(x[1])) for x in rows]
+
+    def _cycle_relation(self):
+        row = self.connection.execute(
+            "SELECT id FROM deferred_relations WHERE scope = ? ORDER BY rowid LIMIT 1",
+            (self.scope,),
+        ).fetchone()
+        if row is None:
+            return []
+        # Following the deferred dependencies from any relation ends on a cycle
+        relation_id = row[0]
+        visited = set()
+        while relation_id not in visited:
+            visited.add(relation_id)
+            relation_id = self.connection.execute(
+                "SELECT d.dependency FROM deferred_dependencies d "
+                "JOIN deferred_relations p ON p.scope = d.scope AND p.id = d.dependency "
+                "WHERE d.scope = ? AND d.id = ? LIMIT 1",
+                (self.scope, relation_id),
+            ).fetchone()[0]
+        return self.connection.execute(
+            "SELECT id, bundles FROM deferred_relations WHERE scope = ? AND id = ?",
+            (self.scope, relation_id),
+        ).fetchall()
+
+    def write(self):
+        # Written once the page is confirmed, committed by the next set_state
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO deferred_relations "
+                "(scope, id, dependencies, bundles) VALUES (?, ?, ?, ?)",
+                [
+                    (self.scope, x, json.dumps(y[0]), json.dumps(y[2]))
+                    for x, y in self.deferred.items()
+                ],
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO deferred_dependencies "
+                "(scope, dependency, id) VALUES (?, ?, ?)",
+                [(self.scope, z, x) for x, y in self.deferred.items() for z in y[1]],
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO emitted_relations (scope, id) VALUES (?, ?)",
+                [(self.scope, x) for x in self.emitted],
+            )
+            self.connection.executemany(
+                "DELETE FROM deferred_relations WHERE scope = ? AND id = ?",
+                [(self.scope, x) for x in self.released],
+            )
+            self.connection.executemany(
+                "DELETE FROM deferred_dependencies WHERE scope = ? AND id = ?",
+                [(self.scope, x) for x in self.released],
+            )
+        self.emitted = set()
+        self.deferred = {}
+        self.released = set()
+
+    def clear_emitted(self):
+        # Once the deferred relations are sent, no relation waits for an emitted one
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM emitted_relations WHERE scope = ?", (self.scope,)
+            )
+
+
+class ExportCache:
+    # Only the last exported version of each entity is published again
+    LATEST_RECORDS = (
+        "FROM records WHERE step = ? AND sequence IN "
+        "(SELECT MAX(sequence) FROM records WHERE step = ? GROUP BY entity_id)"
+    )
+
+    def __init__(self, directory, segment_prefix, segment_max_size):
+        self.directory = directory
+        self.segment_prefix = segment_prefix
+        self.segment_max_size = segment_max_size
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(directory, "index.db"), timeout=60, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS records "
+                "(sequence INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, "
+                "step INTEGER NOT NULL, entity_id TEXT NOT NULL, segment TEXT NOT NULL, "
+                "offset INTEGER NOT NULL, length INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_step ON records (step, entity_id)"
+            )
+        self.segment_number = 0
+        self.segment = None
+        self._open_segment()
+
+    @staticmethod
+    def key(step, entity_id, updated_at):
+        return hashlib.sha256(
+            (str(step) + "|" + entity_id + "|" + str(updated_at)).encode("utf-8")
+        ).hexdigest()
+
+    def _open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        # Each process appends to its own segments
+        while True:
+            self.segment_number += 1
+            self.segment_name = (
+                self.segment_prefix + "-" + str(self.segment_number).zfill(6) + ".bin"
+            )
+            segment_path = os.path.join(self.directory, self.segment_name)
+            if (
+                not os.path.isfile(segment_path)
+                or os.path.getsize(segment_path) < self.segment_max_size
+            ):
+                break
+        self.segment = open(segment_path, "ab")
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT segment, offset, length FROM records WHERE key = ?", (key,)
+            ).fetchone()
+        return self._read(row) if row is not None else None
+
+    def _read(self, row):
+        segment, offset, length = row
+        with open(os.path.join(self.directory, segment), "rb") as segment_file:
+            segment_file.seek(offset)
+            return json.loads(zlib.decompress(segment_file.read(length)))
+
+    def put(self, key, step, entity_id, bundles):
+        record = zlib.compress(json.dumps(bundles).encode("utf-8"))
+        with self.lock:
+            if self.segment.tell() >= self.segment_max_size:
+                self._open_segment()
+            offset = self.segment.tell()
+            self.segment.write(record)
+            self.segment.flush()
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO records "
+                    "(key, step, entity_id, segment, offset, length) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, step, entity_id, self.segment_name, offset, len(record)),
+                )
+
+    def count(self, step):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) " + self.LATEST_RECORDS, (step, step)
+            ).fetchone()[0]
+
+    def stream(self, step, after, size):
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT sequence, entity_id, segment, offset, length "
+                    + self.LATEST_RECORDS
+                    + " AND sequence > ? ORDER BY sequence LIMIT ?",
+                    (step, step, after or 0, size),
+                ).fetchall()
+            if len(rows) == 0:
+                return
+            yield [(row[0], row[1], self._read(row[2:])) for row in rows]
+            after = rows[-1][0]
+
+
+class ShardWriter:
+    def __init__(self, directory, name, max_size):
+        self.directory = directory
+        self.name = name
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_file = os.path.join(directory, "manifest-" + name + ".json")
+        self.manifest = {"shards": []}
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, "r") as manifest_file_handler:
+                self.manifest = json.load(manifest_file_handler)
+        self.step = None
+        self.shard = None
+        self.shard_file = None
+        self.shard_messages = 0
+        self.callbacks = []
+        self.reconnects = 0
+        self.retries = 0
+
+    def begin_step(self, step):
+        # A shard only holds the messages of one step
+        if self.step != step:
+            self._close_shard()
+            self.step = step
+
+    def _open_shard(self):
+        # A shard left by a crash keeps the messages written before its last flush
+        shard_name = (
+            "shard-"
+            + self.name
+            + "-"
+            + str(len(self.manifest["shards"]) + 1).zfill(6)
+            + ".jsonl.gz"
+        )
+        self.shard_file = open(os.path.join(self.directory, shard_name), "wb")
+        self.shard = gzip.GzipFile(fileobj=self.shard_file, mode="wb")
+        self.shard_messages = 0
+        self.manifest["shards"].append(
+            {"name": shard_name, "step": self.step, "messages": 0, "size": 0}
+        )
+
+    def _close_shard(self):
+        if self.shard is None:
+            return
+        self.wait_for_confirms()
+        self.shard.close()
+        self.shard_file.close()
+        self.shard = None
+        self.manifest["shards"][-1]["size"] = os.path.getsize(
+            os.path.join(self.directory, self.manifest["shards"][-1]["name"])
+        )
+        self._write_manifest()
+
+    def _write_manifest(self):
+        with open(self.manifest_file + ".tmp", "w") as manifest_file_handler:
+            json.dump(self.manifest, manifest_file_handler)
+            manifest_file_handler.flush()
+            os.fsync(manifest_file_handler.fileno())
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+
+    def publish(self, body, callback=None):
+        if self.shard is None:
+            self._open_shard()
+        self.shard.write(body + b"\n")
+        self.shard_messages += 1
+        if callback is not None:
+            self.callbacks.append(callback)
+        if self.shard_file.tell() >= self.max_size:
+            self._close_shard()
+
+    def wait_for_confirms(self):
+        if self.shard is not None:
+            self.shard.flush()
+            os.fsync(self.shard_file.fileno())
+            self.manifest["shards"][-1]["messages"] = self.shard_messages
+            self._write_manifest()
+        for callback in self.callbacks:
+            callback()
+        self.callbacks = []
+
+    def close(self):
+        self._close_shard()
+
+
+def read_shard(path, messages):
+    # Decompressed as a stream as the shard of a crash has no gzip trailer
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buffer = b""
+    with open(path, "rb") as shard_file:
+        while messages > 0:
+            chunk = shard_file.read(1048576)
+            if len(chunk) == 0:
+                break
+            buffer += decompressor.decompress(chunk)
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines[:messages]:
+                yield line
+            messages -= min(len(lines), messages)
+
+
+def future_results(future):
+    # Results of a future, only waited for when they are read
+    yield from future.result()
+
+
+def summarize(values):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": values[int(0.5 * (len(values) - 1))],
+        "p95": values[int(0.95 * (len(values) - 1))],
+        "p99": values[int(0.99 * (len(values) - 1))],
+        "max": values[-1],
+    }
+
+
+class Migrate:
+    def __init__(
+        self,
+        partition=None,
+        from_cache=False,
+        load_shards=False,
+        delta=False,
+        profile=False,
+    ):
         logging.getLogger("pika").setLevel(logging.ERROR)
         welcome_art = text2art("OpenCTI migrator")
         print(welcome_art)
@@ -68,431 +1363,1502 @@ class Migrate:
             if config not in config:
                 raise ValueError("Missing configuration parameter: " + config)
 
-        # Test connection to the V3 API
-        self.opencti_api_client = OpenCTIApiClient(
-            self.config["opencti_v3_url"], self.config["opencti_v3_token"], "error"
+        # Each step can be split in created_at ranges migrated by parallel processes
+        self.partitions = int(self.config.get("opencti_migration_partitions", 1))
+        self.partition = partition
+
+        # Entities are converted from their listing instead of being read one by one
+        self.bulk_export = str(
+            self.config.get("opencti_migration_bulk_export", True)
+        ).lower() in ["true", "1", "yes"]
+
+        # Number of entities exported in parallel for each page
+        self.workers = int(self.config.get("opencti_migration_workers", 4))
+
+        # Number of pages listed and exported ahead of the publication
+        self.prefetch_pages = int(
+            self.config.get("opencti_migration_prefetch_pages", 2)
         )
-        print("Checking access to OpenCTI version 3.3.2 instance... OK")
 
-        # Check RabbitMQ
-        self.connection = None
-        self.channel = None
-        self._rabbitmq_connect()
-        print("Checking access to the OpenCTI versio 4.X.X RabbitMQ... OK")
+        # Exported bundles can be kept on disk to be published again without the V3 API
+        self.cache = None
+        if "opencti_migration_cache_directory" in self.config:
+            self.cache = ExportCache(
+                self.config["opencti_migration_cache_directory"],
+                "segment-" + self._state_key(partition),
+                int(self.config.get("opencti_migration_cache_segment_size", 268435456)),
+            )
+        elif from_cache:
+            raise ValueError(
+                "Missing configuration parameter: opencti_migration_cache_directory"
+            )
+
+        # Test connection to the V3 API
+        if not from_cache and not load_shards:
+            self.opencti_api_client = OpenCTIApiClient(
+                self.config["opencti_v3_url"], self.config["opencti_v3_token"], "error"
+            )
+            print("Checking access to OpenCTI version 3.3.2 instance... OK")
+
+        # Check RabbitMQ, or the directory of the shards when exporting to files
+        if profile:
+            # The profile only reads the V3 API
+            self.publisher = None
+        elif self.config.get("opencti_migration_sink", "rabbitmq") == "file" and not (
+            load_shards
+        ):
+            self.publisher = ShardWriter(
+                self.config["opencti_migration_export_directory"],
+                self._state_key(partition),
+                int(self.config.get("opencti_migration_shard_size", 104857600)),
+            )
+            print("Checking access to the export directory... OK")
+        else:
+            self.publisher = self._rabbitmq_publisher()
+            print("Checking access to the OpenCTI versio 4.X.X RabbitMQ... OK")
+
+        # The publication follows the depth of the queue of the V4 workers
+        self.flow_controller = None
+        if str(self.config.get("opencti_migration_flow_control", False)).lower() in [
+            "true",
+            "1",
+            "yes",
+        ] and isinstance(self.publisher, (RabbitMQPublisher, RabbitMQConfirmPublisher)):
+            self.flow_controller = FlowController(
+                self._rabbitmq_parameters(),
+                self.config.get(
+                    "opencti_v4_rabbitmq_push_queue",
+                    "push_" + self.config["opencti_v4_import_file_stix_connector_id"],
+                ),
+                int(self.config.get("opencti_migration_flow_low_watermark", 10000)),
+                int(self.config.get("opencti_migration_flow_high_watermark", 100000)),
+                float(self.config.get("opencti_migration_flow_interval", 5)),
+                float(self.config.get("opencti_migration_flow_initial_rate", 50)),
+                float(self.config.get("opencti_migration_flow_rate_increase", 10)),
+            )
+
+        # Latencies and throughput, also served in the Prometheus format with a port
+        self.metrics = Metrics()
+        self.metrics.publisher = self.publisher
+        self.report_directory = self.config.get(
+            "opencti_migration_report_directory",
+            os.path.dirname(os.path.abspath(__file__)),
+        )
+        metrics_port = int(self.config.get("opencti_migration_metrics_port", 0))
+        if metrics_port > 0:
+            # Each partition serves its own metrics on the next ports
+            self._serve_metrics(
+                self.config.get("opencti_migration_metrics_host", "127.0.0.1"),
+                metrics_port + (0 if partition is None else partition + 1),
+            )
 
         # Check if state already here or is creatable
-        self.state_file = os.path.dirname(os.path.abspath(__file__)) + "/state.json"
+        self.store = CheckpointStore(
+            os.path.dirname(os.path.abspath(__file__)) + "/state.db"
+        )
+        if from_cache:
+            self.state_key = "cache"
+        elif load_shards:
+            self.state_key = "load"
+        elif delta:
+            self.state_key = "delta"
+        elif profile:
+            self.state_key = "profile"
+        else:
+            self.state_key = self._state_key(partition)
         print("Checking if the state file is writtable... OK")
         self.get_state()
 
-    def _rabbitmq_connect(self):
-        # Test connection to the RabbitMQ
-        credentials = pika.PlainCredentials(
-            self.config["opencti_v4_rabbitmq_user"],
-            self.config["opencti_v4_rabbitmq_password"],
+        # Relations to relations are sent once the relations they point to are sent
+        self.deferred_relations = DeferredRelations(
+            self.store, "cache" if from_cache else "migration"
+        )
+
+        # Authors and markings already sent, up to a memory budget in bytes
+        self.seen_objects = None
+        seen_objects_memory = int(
+            self.config.get("opencti_migration_seen_objects_memory", 67108864)
         )
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=self.config["opencti_v4_rabbitmq_hostname"],
-                port=self.config["opencti_v4_rabbitmq_port"],
-                credentials=credentials,
+        if seen_objects_memory > 0:
+            self.seen_objects = SeenObjects(seen_objects_memory)
+            self.seen_objects.load(self.store.get_seen_objects(self.state_key))
+
+        # Objects already confirmed are skipped when the migration is run again
+        self.published_objects = None
+        if str(self.config.get("opencti_migration_replay_safe", False)).lower() in [
+            "true",
+            "1",
+            "yes",
+        ]:
+            self.published_objects = PublishedObjects(
+                os.path.dirname(os.path.abspath(__file__)) + "/state.db"
             )
+
+        # Containers with more references are sent in chunks of their object_refs
+        self.container_max_refs = int(
+            self.config.get("opencti_migration_container_max_refs", 10000)
+        )
+        self.container_chunk_size = int(
+            self.config.get("opencti_migration_container_chunk_size", 1048576)
         )
-        self.channel = self.connection.channel()
 
-    def get_state(self):
-        if os.path.isfile(self.state_file):
-            with open(self.state_file, "r") as state_file_handler:
-                return json.load(state_file_handler)
-        else:
-            with open(self.state_file, "w") as state_file_handler:
-                json.dump(
-                    {"step": None, "after": None, "number": 0}, state_file_handler
-                )
-                return {"step": None, "after": None, "number": 0}
+        # The content of the messages can be compressed for the workers supporting it
+        self.content_encoding = self.config.get(
+            "opencti_migration_content_encoding", "identity"
+        )
+        self.compression_level = int(
+            self.config.get("opencti_migration_compression_level", 6)
+        )
 
-    def set_state(self, state):
-        with open(self.state_file, "w") as state_file_handler:
-            json.dump(state, state_file_handler)
-        return state
+        # Objects are grouped in bundles up to a number of objects or a size in bytes
+        self.bundle_aggregator = BundleAggregator(
+            self._send_bundle,
+            int(self.config.get("opencti_migration_bundle_max_objects", 100)),
+            int(self.config.get("opencti_migration_bundle_max_size", 5242880)),
+            self.seen_objects,
+            self.published_objects,
+        )
 
-    def _send_bundle(self, bundle, retry=False):
-        message = {
-            "job_id": None,
-            "applicant_id": None,
-            "content": base64.b64encode(bundle.encode("utf-8")).decode("utf-8"),
-        }
-        # Send the message
+    def _serve_metrics(self, host, port):
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        server.metrics = self.metrics
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def _write_report(self, step):
+        report = dict(self.metrics.report(step), partition=self.state_key)
+        report_file = os.path.join(
+            self.report_directory,
+            "report-" + self.state_key + "-step-" + str(step) + ".json",
+        )
+        with open(report_file, "w") as report_file_handler:
+            json.dump(report, report_file_handler, indent=2)
+
+    def _rabbitmq_parameters(self):
+        credentials = pika.PlainCredentials(
+            self.config["opencti_v4_rabbitmq_user"],
+            self.config["opencti_v4_rabbitmq_password"],
+        )
+        return pika.ConnectionParameters(
+            host=self.config["opencti_v4_rabbitmq_hostname"],
+            port=int(self.config["opencti_v4_rabbitmq_port"]),
+            credentials=credentials,
+        )
+
+    def _rabbitmq_publisher(self):
+        parameters = self._rabbitmq_parameters()
         routing_key = (
             "push_routing_" + self.config["opencti_v4_import_file_stix_connector_id"]
         )
-        try:
-            self.channel.basic_publish(
-                exchange="amqp.worker.exchange",
-                routing_key=routing_key,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # make message persistent
-                ),
+        if self.config.get("opencti_v4_rabbitmq_publisher", "blocking") == "confirm":
+            # Asynchronous publisher confirms with a window of unconfirmed messages
+            return RabbitMQConfirmPublisher(
+                parameters,
+                "amqp.worker.exchange",
+                routing_key,
+                int(self.config.get("opencti_v4_rabbitmq_confirm_window", 1000)),
+                int(self.config.get("opencti_v4_rabbitmq_confirm_timeout", 30)),
+                int(self.config.get("opencti_v4_rabbitmq_max_retries", 5)),
             )
-        except:
-            if retry is False:
-                self._rabbitmq_connect()
-                self._send_bundle(bundle, True)
-            else:
-                raise ValueError("Impossible to send a message to RabbitMQ")
+        return RabbitMQPublisher(parameters, "amqp.worker.exchange", routing_key)
 
-    def start(self):
-        state = self.get_state()
-        if state["step"] is not None:
-            print(
-                "A current state has been found, resuming to step "
-                + str(state["step"])
-                + " with cursor "
-                + str(state["after"])
-            )
-        # 1. MIGRATION OF STIX DOMAIN OBJECT
-        if state["step"] is None or state["step"] == 1:
-            print(" ")
-            print("STEP 1: MIGRATION OF STIX DOMAIN OBJECTS (except containers)")
-            print(" ")
-            data = {"pagination": {"hasNextPage": True, "endCursor": state["after"]}}
-            count = self.opencti_api_client.stix_domain_entity.list(
-                first=1,
-                withPagination=True,
-                customAttributes="""
-                    id
-                    entity_type
-                """,
-                orderBy="created_at",
-                orderMode="asc",
+    def _state_key(self, partition):
+        return "main" if partition is None else "partition-" + str(partition)
+
+    def get_state(self):
+        state = self.store.get_state(self.state_key)
+        if state is None:
+            state = {"step": None, "after": None, "number": 0}
+            # Resume from the state file of the previous versions of the script
+            state_file = os.path.dirname(os.path.abspath(__file__)) + "/state.json"
+            if self.state_key == "main" and os.path.isfile(state_file):
+                with open(state_file, "r") as state_file_handler:
+                    state = json.load(state_file_handler)
+                os.rename(state_file, state_file + ".bak")
+            self.store.set_state(self.state_key, state)
+        return state
+
+    def set_state(self, state):
+        return self.store.set_state(self.state_key, state)
+
+    def _encode_message(self, bundle):
+        # The bundle is already serialized, it is only wrapped in the message
+        if self.content_encoding == "gzip":
+            return b"".join(
+                [
+                    GZIP_MESSAGE_PREFIX,
+                    binascii.b2a_base64(
+                        gzip.compress(bundle, self.compression_level), newline=False
+                    ),
+                    MESSAGE_SUFFIX,
+                ]
             )
-            with progressbar.ProgressBar(
-                max_value=count["pagination"]["globalCount"]
-            ) as bar:
-                while data["pagination"]["hasNextPage"]:
-                    after = data["pagination"]["endCursor"]
-                    data = self.opencti_api_client.stix_domain_entity.list(
-                        first=100,
-                        after=after,
-                        withPagination=True,
-                        orderBy="created_at",
-                        customAttributes="""
-                            id
-                            entity_type
-                        """,
-                        orderMode="asc",
-                    )
-                    local_number = 0
-                    for stix_domain_entity in data["entities"]:
-                        if (
-                            stix_domain_entity["entity_type"] != "report"
-                            and stix_domain_entity["entity_type"] != "note"
-                        ):
-                            bundle = self.opencti_api_client.stix2.export_entity(
-                                stix_domain_entity["entity_type"],
-                                stix_domain_entity["id"],
-                            )
-                            bundle_objects = copy.deepcopy(bundle["objects"])
-                            bundle["objects"] = []
-                            for bundle_object in bundle_objects:
-                                if (
-                                    "x_opencti_identity_type" in bundle_object
-                                    and bundle_object["x_opencti_identity_type"]
-                                    in ["Region", "Country", "City"]
-                                ):
-                                    bundle_object["type"] = "location"
-                                    bundle_object["id"] = bundle_object["id"].replace(
-                                        "identity", "location"
-                                    )
-                                    bundle_object[
-                                        "x_opencti_location_type"
-                                    ] = bundle_object["x_opencti_identity_type"]
-                                if "labels" in bundle_object:
-                                    del bundle_object["labels"]
-                                bundle["objects"].append(bundle_object)
-                            self._send_bundle(json.dumps(bundle))
-                        local_number += 1
-                    state = self.set_state(
-                        {
-                            "step": 1,
-                            "after": after,
-                            "number": state["number"] + local_number,
-                        }
-                    )
-                    bar.update(
-                        state["number"]
-                        if state["number"] <= count["pagination"]["globalCount"]
-                        else count["pagination"]["globalCount"]
+        return b"".join(
+            [MESSAGE_PREFIX, binascii.b2a_base64(bundle, newline=False), MESSAGE_SUFFIX]
+        )
+
+    def _send_bundle(self, bundle, callback=None, serialize_duration=0):
+        if self.flow_controller is not None:
+            self.flow_controller.throttle()
+        started_at = time.perf_counter()
+        message = self._encode_message(bundle)
+        self.metrics.observe(
+            "encode", serialize_duration + time.perf_counter() - started_at
+        )
+        self.metrics.increment("messages")
+        self.metrics.increment("bytes", len(message))
+        with self.metrics.time("publish"):
+            self.publisher.publish(message, callback)
+
+    def _bulk_export_attributes(self, entity_types):
+        custom_attributes = """
+            id
+            entity_type
+            updated_at
+        """
+        if not self.bulk_export:
+            return custom_attributes
+        graphql_types = []
+        for entity_type in entity_types:
+            graphql_type, api_entity = BULK_EXPORT_TYPES[entity_type]
+            if graphql_type not in graphql_types:
+                graphql_types.append(graphql_type)
+                custom_attributes += (
+                    "... on "
+                    + graphql_type
+                    + " {"
+                    + getattr(self.opencti_api_client, api_entity).properties
+                    + "}\n"
+                )
+        return custom_attributes
+
+    def _export_entity(self, entity):
+        # Entities listed with all their fields are converted without another query
+        if (
+            self.bulk_export
+            and entity["entity_type"] in BULK_EXPORT_TYPES
+            and "stix_id_key" in entity
+        ):
+            api_entity = BULK_EXPORT_TYPES[entity["entity_type"]][1]
+            try:
+                objects = getattr(self.opencti_api_client, api_entity).to_stix2(
+                    entity=entity
+                )
+                return {
+                    "type": "bundle",
+                    "id": "bundle--" + str(uuid.uuid4()),
+                    "objects": objects if objects is not None else [],
+                }
+            except KeyError:
+                pass
+        return self.opencti_api_client.stix2.export_entity(
+            entity["entity_type"], entity["id"]
+        )
+
+    def _export_stix_domain_entity(self, stix_domain_entity):
+        if stix_domain_entity["entity_type"] in ["report", "note"]:
+            return []
+        bundle = self._export_entity(stix_domain_entity)
+        # The exported objects are not shared, they are transformed in place
+        with self.metrics.time("transform"):
+            for bundle_object in bundle["objects"]:
+                if "x_opencti_identity_type" in bundle_object and bundle_object[
+                    "x_opencti_identity_type"
+                ] in ["Region", "Country", "City"]:
+                    bundle_object["type"] = "location"
+                    bundle_object["id"] = bundle_object["id"].replace(
+                        "identity", "location"
                     )
+                    bundle_object["x_opencti_location_type"] = bundle_object[
+                        "x_opencti_identity_type"
+                    ]
+                if "labels" in bundle_object:
+                    del bundle_object["labels"]
+        return [bundle]
 
-        # 2. MIGRATION OF STIX CYBER OBSERVABLE
-        if state["step"] == 1:
-            state = self.set_state({"step": 2, "after": None, "number": 0})
-        if state["step"] == 2:
-            print(" ")
-            print("STEP 2: MIGRATION OF STIX CYBER OBSERVABLES")
-            print(" ")
-            data = {"pagination": {"hasNextPage": True, "endCursor": state["after"]}}
-            count = self.opencti_api_client.stix_observable.list(
-                first=1,
-                withPagination=True,
-                customAttributes="""
-                    id
-                    entity_type
-                """,
-                orderBy="created_at",
-                orderMode="asc",
-            )
-            with progressbar.ProgressBar(
-                max_value=count["pagination"]["globalCount"]
-            ) as bar:
-                while data["pagination"]["hasNextPage"]:
-                    after = data["pagination"]["endCursor"]
-                    data = self.opencti_api_client.stix_observable.list(
-                        first=100,
-                        after=after,
-                        withPagination=True,
-                        orderBy="created_at",
-                        orderMode="asc",
+    def _shared_reference(self, entity):
+        # Author or marking definition converted by pycti for a reduced entity
+        reference_stix = {"id": None, "type": "x-opencti-simple-observable"}
+        shared_reference = self.opencti_api_client.stix2.prepare_export(
+            entity, reference_stix
+        )[0]
+        if "labels" in shared_reference:
+            del shared_reference["labels"]
+        return shared_reference
+
+    def _export_stix_observables(self, stix_observables):
+        # A page of observables is converted in one pass from its listing, the
+        # authors and marking definitions of the page being converted only once
+        created_by_refs = {}
+        marking_definitions = {}
+        page_bundles = []
+        with self.metrics.time("transform"):
+            for stix_observable in stix_observables:
+                observable_stix = {
+                    "id": stix_observable["stix_id_key"],
+                    "type": "x-opencti-simple-observable",
+                    "key": OBSERVABLE_KEYS[stix_observable["entity_type"]],
+                    "value": stix_observable["observable_value"],
+                    "description": stix_observable["description"],
+                }
+                if (
+                    len(stix_observable.get("tags") or []) > 0
+                    or len(stix_observable.get("externalReferences") or []) > 0
+                ):
+                    # Tags and external references are specific to each observable
+                    bundle_objects = self.opencti_api_client.stix2.prepare_export(
+                        stix_observable, observable_stix
                     )
-                    local_number = 0
-                    for stix_observable in data["entities"]:
-                        observable_stix = {
-                            "id": stix_observable["stix_id_key"],
-                            "type": "x-opencti-simple-observable",
-                            "key": OBSERVABLE_KEYS[stix_observable["entity_type"]],
-                            "value": stix_observable["observable_value"],
-                            "description": stix_observable["description"],
-                        }
-                        original_bundle_objects = (
-                            self.opencti_api_client.stix2.prepare_export(
-                                stix_observable, observable_stix
+                    for bundle_object in bundle_objects:
+                        if "labels" in bundle_object:
+                            del bundle_object["labels"]
+                else:
+                    bundle_objects = []
+                    created_by_ref = stix_observable.get("createdByRef")
+                    if created_by_ref is not None:
+                        if created_by_ref["id"] not in created_by_refs:
+                            created_by_refs[created_by_ref["id"]] = (
+                                self._shared_reference(
+                                    {
+                                        "createdByRef": created_by_ref,
+                                        "markingDefinitions": [],
+                                    }
+                                )
                             )
-                        )
-                        bundle_objects = []
-                        for original_bundle_object in original_bundle_objects:
-                            if "labels" in original_bundle_object:
-                                del original_bundle_object["labels"]
-                            bundle_objects.append(original_bundle_object)
-                        bundle = {"type": "bundle", "objects": bundle_objects}
-                        self._send_bundle(json.dumps(bundle))
-
-                        # If indicators
-                        if (
-                            "indicatorsIds" in stix_observable
-                            and len(stix_observable["indicatorsIds"]) > 0
-                        ):
-                            for indicator_id in stix_observable["indicatorsIds"]:
-                                relation_stix = {
-                                    "id": "relationship--" + str(uuid.uuid4()),
+                        bundle_objects.append(created_by_refs[created_by_ref["id"]])
+                        observable_stix["created_by_ref"] = bundle_objects[-1]["id"]
+                    entity_marking_definitions = (
+                        stix_observable.get("markingDefinitions") or []
+                    )
+                    if len(entity_marking_definitions) > 0:
+                        for entity_marking_definition in entity_marking_definitions:
+                            if entity_marking_definition["id"] not in (
+                                marking_definitions
+                            ):
+                                marking_definitions[entity_marking_definition["id"]] = (
+                                    self._shared_reference(
+                                        {
+                                            "markingDefinitions": [
+                                                entity_marking_definition
+                                            ]
+                                        }
+                                    )
+                                )
+                            bundle_objects.append(
+                                marking_definitions[entity_marking_definition["id"]]
+                            )
+                        observable_stix["object_marking_refs"] = [
+                            x["stix_id_key"] for x in entity_marking_definitions
+                        ]
+                    bundle_objects.append(observable_stix)
+                bundles = [{"type": "bundle", "objects": bundle_objects}]
+                # The based-on relations of the indicators are sent in one bundle
+                indicator_ids = stix_observable.get("indicatorsIds") or []
+                if len(indicator_ids) > 0:
+                    bundles.append(
+                        {
+                            "type": "bundle",
+                            "objects": [
+                                {
+                                    # The same link always has the same id
+                                    "id": "relationship--"
+                                    + str(
+                                        uuid.uuid5(
+                                            BASED_ON_NAMESPACE,
+                                            indicator_id
+                                            + " "
+                                            + stix_observable["stix_id_key"],
+                                        )
+                                    ),
                                     "type": "relationship",
                                     "relationship_type": "based-on",
                                     "source_ref": indicator_id,
                                     "target_ref": stix_observable["stix_id_key"],
                                 }
-                                bundle = {"type": "bundle", "objects": [relation_stix]}
-                                self._send_bundle(json.dumps(bundle))
-                        local_number += 1
-                    state = self.set_state(
-                        {
-                            "step": 2,
-                            "after": after,
-                            "number": state["number"] + local_number,
+                                for indicator_id in indicator_ids
+                            ],
                         }
                     )
-                    bar.update(
-                        state["number"]
-                        if state["number"] <= count["pagination"]["globalCount"]
-                        else count["pagination"]["globalCount"]
+                page_bundles.append(bundles)
+        return page_bundles
+
+    def _export_stix_observable(self, stix_observable):
+        return self._export_stix_observables([stix_observable])[0]
+
+    def _export_stix_relation(self, stix_relation):
+        # The listing of the relations already returns all their fields
+        if self.bulk_export:
+            bundle_objects = self.opencti_api_client.stix_relation.to_stix2(
+                entity=stix_relation
+            )
+        else:
+            bundle_objects = self.opencti_api_client.stix_relation.to_stix2(
+                id=stix_relation["id"]
+            )
+        return [{"type": "bundle", "objects": bundle_objects}]
+
+    def _split_observed_data(self, container_id, observed_data, first_index):
+        # The observables of an observed data are split in several ones, numbered in
+        # the container so they have the same ids when the container is exported again
+        parts = [[]]
+        size = 0
+        for observed_object in observed_data["objects"]:
+            object_size = len(json_dumps(observed_object)) + 1
+            if len(parts[-1]) > 0 and size + object_size > self.container_chunk_size:
+                parts.append([])
+                size = 0
+            parts[-1].append(observed_object)
+            size += object_size
+        if len(parts) == 1:
+            return [observed_data]
+        return [
+            dict(
+                observed_data,
+                id="observed-data--"
+                + str(
+                    uuid.uuid5(
+                        OBSERVED_DATA_NAMESPACE,
+                        container_id + " " + str(index),
                     )
+                ),
+                number_observed=len(part),
+                objects=part,
+            )
+            for index, part in enumerate(parts, first_index)
+        ]
 
-        # 3. MIGRATION OF STIX CORE RELATIONSHIPS
-        if state["step"] == 2:
-            state = self.set_state({"step": 3, "after": None, "number": 0})
-        if state["step"] == 3:
-            print(" ")
-            print("STEP 3: MIGRATION OF STIX CORE RELATIONSHIPS")
-            print(" ")
-            data = {"pagination": {"hasNextPage": True, "endCursor": state["after"]}}
-            count = self.opencti_api_client.stix_relation.list(
+    def _split_container(self, bundle):
+        # The referenced objects are already sent by the previous steps, only their
+        # ids are sent, in copies of the container each adding a part of its refs
+        container = bundle["objects"][-1]
+        object_refs = container.pop("object_refs")
+        observed_data = {
+            x["id"]: x for x in bundle["objects"][:-1] if x["type"] == "observed-data"
+        }
+        bundles = []
+        refs = []
+        parts_number = 0
+        for object_ref in object_refs:
+            if object_ref in observed_data:
+                parts = self._split_observed_data(
+                    container["id"], observed_data.pop(object_ref), parts_number
+                )
+                parts_number += len(parts)
+                for part in parts:
+                    bundles.append({"type": "bundle", "objects": [part]})
+                    refs.append(part["id"])
+            else:
+                refs.append(object_ref)
+        # The authors and markings are sent with the first chunk
+        bundle_objects = [
+            x for x in bundle["objects"][:-1] if x["type"] != "observed-data"
+        ]
+        chunk_start = 0
+        size = 0
+        for index, object_ref in enumerate(refs):
+            ref_size = len(object_ref) + 3
+            if index > chunk_start and size + ref_size > self.container_chunk_size:
+                bundle_objects.append(
+                    dict(container, object_refs=refs[chunk_start:index])
+                )
+                bundles.append({"type": "bundle", "objects": bundle_objects})
+                bundle_objects = []
+                chunk_start = index
+                size = 0
+            size += ref_size
+        bundle_objects.append(dict(container, object_refs=refs[chunk_start:]))
+        bundles.append({"type": "bundle", "objects": bundle_objects})
+        return bundles
+
+    def _export_container(self, stix_domain_entity):
+        bundle = self._export_entity(stix_domain_entity)
+        with self.metrics.time("transform"):
+            for bundle_object in bundle["objects"]:
+                if "labels" in bundle_object:
+                    del bundle_object["labels"]
+            if (
+                self.container_max_refs > 0
+                and len(bundle["objects"]) > 0
+                and len(bundle["objects"][-1].get("object_refs") or [])
+                > self.container_max_refs
+            ):
+                return self._split_container(bundle)
+        return [bundle]
+
+    def _progress_bar(self, max_value):
+        suffix = " Skipped: {variables.skipped}"
+        variables = {"skipped": 0}
+        if self.flow_controller is not None:
+            suffix += " Rate: {variables.rate}"
+            variables["rate"] = "-"
+        return progressbar.ProgressBar(
+            max_value=max_value, suffix=suffix, variables=variables
+        )
+
+    def _update_progress(self, bar, value):
+        # Entities created since the count of the step extend the bar
+        if bar.max_value is not None and value > bar.max_value:
+            bar.max_value = value
+        variables = {}
+        if "skipped" in bar.variables:
+            variables["skipped"] = self.metrics.get("entities_skipped")
+        if "rate" in bar.variables:
+            variables["rate"] = self.flow_controller.describe()
+        bar.update(value, **variables)
+
+    def _close(self):
+        self.publisher.close()
+        if self.flow_controller is not None:
+            self.flow_controller.close()
+
+    def _begin_step(self, step):
+        self.metrics.begin_step(step)
+        # The aggregator counters are cumulative, the summary is by step
+        self.step_objects_sent = self.bundle_aggregator.objects_sent
+        self.step_messages_sent = self.bundle_aggregator.messages_sent
+        if isinstance(self.publisher, ShardWriter):
+            self.publisher.begin_step(step)
+
+    def _print_sent(self):
+        print(
+            "Objects sent: "
+            + str(self.bundle_aggregator.objects_sent - self.step_objects_sent)
+            + ", messages sent: "
+            + str(self.bundle_aggregator.messages_sent - self.step_messages_sent)
+        )
+
+    def _add_published_objects(self):
+        # Indexed before their entities are marked as published, so none is missed
+        published_digests = self.bundle_aggregator.pop_published_digests()
+        if self.published_objects is not None and len(published_digests) > 0:
+            self.published_objects.add(published_digests)
+
+    def _publish_page(self, state, step, end_cursor, number, entity_ids, page_bundles):
+        objects_sent = self.bundle_aggregator.objects_sent
+        objects_skipped = self.bundle_aggregator.objects_skipped
+        # The bundles are sent in the page order
+        for entity_id, bundles in zip(entity_ids, page_bundles):
+            if step == 3:
+                ordered_bundles = self.deferred_relations.order(bundles)
+                # A deferred relation is only written with the state of the page, it is
+                # not published before, so a crash lists it again
+                if len(ordered_bundles) == 0 and len(bundles) > 0:
+                    continue
+                bundles = ordered_bundles
+            for bundle in bundles:
+                self.bundle_aggregator.add(bundle)
+            self.bundle_aggregator.mark(entity_id)
+            self._add_published_objects()
+            confirmed_ids = self.bundle_aggregator.pop_published_ids()
+            if len(confirmed_ids) > 0:
+                self.store.add_published(self.state_key, confirmed_ids)
+        self.bundle_aggregator.flush()
+        with self.metrics.time("confirm"):
+            self.publisher.wait_for_confirms()
+        self._add_published_objects()
+        self.bundle_aggregator.pop_published_ids()
+        self.metrics.increment("entities", number)
+        self.metrics.increment(
+            "objects", self.bundle_aggregator.objects_sent - objects_sent
+        )
+        self.metrics.increment(
+            "objects_skipped", self.bundle_aggregator.objects_skipped - objects_skipped
+        )
+        # The seen objects are saved with the state, once they are confirmed
+        if self.seen_objects is not None:
+            self.store.update_seen_objects(
+                self.state_key, *self.seen_objects.pop_changes()
+            )
+        self.deferred_relations.write()
+        # The cursor only moves to the next page once this one is fully published, the
+        # ranges of the partitions are kept for a resume of step 4
+        return self.set_state(
+            dict(state, step=step, after=end_cursor, number=state["number"] + number)
+        )
+
+    def _cached_export(self, step, export):
+        def cached_export(entity):
+            key = ExportCache.key(step, entity["id"], entity.get("updated_at"))
+            bundles = self.cache.get(key)
+            if bundles is None:
+                bundles = export(entity)
+                self.cache.put(key, step, entity["id"], bundles)
+            return bundles
+
+        return cached_export
+
+    def _cached_page_export(self, step, page_export):
+        def cached_page_export(entities):
+            keys = [
+                ExportCache.key(step, x["id"], x.get("updated_at")) for x in entities
+            ]
+            page_bundles = [self.cache.get(key) for key in keys]
+            missing = [i for i, x in enumerate(page_bundles) if x is None]
+            if len(missing) > 0:
+                exported = page_export([entities[i] for i in missing])
+                for i, bundles in zip(missing, exported):
+                    self.cache.put(keys[i], step, entities[i]["id"], bundles)
+                    page_bundles[i] = bundles
+            return page_bundles
+
+        return cached_page_export
+
+    def _page_export(self, step):
+        # The observables are converted a page at a time instead of one by one
+        if step == 2:
+            return self._export_stix_observables
+        return None
+
+    def _migrate_step(
+        self,
+        state,
+        step,
+        list_function,
+        list_arguments,
+        export,
+        time_range=None,
+        since=None,
+    ):
+        filters = []
+        if time_range is not None:
+            filters.extend(self._time_range_filters(time_range))
+        # A delta only lists the entities changed since the high-water mark
+        order_by = "created_at"
+        if since is not None:
+            filters.append({"key": "updated_at", "values": [since], "operator": "gt"})
+            order_by = "updated_at"
+        if len(filters) > 0:
+            list_arguments = dict(list_arguments, filters=filters)
+        self._begin_step(step)
+        with self.metrics.time("list"):
+            count = list_function(
                 first=1,
                 withPagination=True,
-                customAttributes="""
-                    id
-                """,
-                orderBy="created_at",
+                orderBy=order_by,
                 orderMode="asc",
+                **list_arguments
             )
-            with progressbar.ProgressBar(
-                max_value=count["pagination"]["globalCount"]
-            ) as bar:
-                while data["pagination"]["hasNextPage"]:
-                    after = data["pagination"]["endCursor"]
-                    data = self.opencti_api_client.stix_relation.list(
+        global_count = count["pagination"]["globalCount"]
+        page_export = self._page_export(step)
+        if self.cache is not None:
+            export = self._cached_export(step, export)
+            if page_export is not None:
+                page_export = self._cached_page_export(step, page_export)
+        # Listing, exporting and publishing run as three stages joined by bounded queues
+        stop = threading.Event()
+        pages = queue.Queue(maxsize=self.prefetch_pages)
+        exported_pages = queue.Queue(maxsize=self.prefetch_pages)
+        result = {"state": state}
+        # Entities of the current page already published before a resume
+        published_ids = self.store.get_published(self.state_key)
+
+        def list_pages():
+            data = {"pagination": {"hasNextPage": True, "endCursor": state["after"]}}
+            while data["pagination"]["hasNextPage"]:
+                after = data["pagination"]["endCursor"]
+                with self.metrics.time("list"):
+                    data = list_function(
                         first=100,
                         after=after,
                         withPagination=True,
-                        customAttributes="""
-                            id
-                        """,
-                        orderBy="created_at",
+                        orderBy=order_by,
                         orderMode="asc",
+                        **list_arguments
                     )
-                    local_number = 0
-                    for stix_relation in data["entities"]:
-                        if not stix_relation["from"]["stix_id_key"].startswith(
-                            "relationship"
-                        ) and not stix_relation["to"]["stix_id_key"].startswith(
-                            "relationship"
-                        ):
-                            bundle_objects = (
-                                self.opencti_api_client.stix_relation.to_stix2(
-                                    id=stix_relation["id"]
-                                )
-                            )
-                            bundle = {"type": "bundle", "objects": bundle_objects}
-                            self._send_bundle(json.dumps(bundle))
-                        local_number += 1
-                    state = self.set_state(
-                        {
-                            "step": 3,
-                            "after": after,
-                            "number": state["number"] + local_number,
-                        }
+                queue_put(
+                    pages, (data["pagination"]["endCursor"], data["entities"]), stop
+                )
+            queue_put(pages, None, stop)
+
+        def timed_export(entity):
+            with self.metrics.time("export"):
+                bundles = export(entity)
+            if len(bundles) == 0:
+                self.metrics.increment("entities_skipped")
+            return bundles
+
+        def timed_page_export(entities):
+            with self.metrics.time("export"):
+                page_bundles = page_export(entities)
+            self.metrics.increment(
+                "entities_skipped", sum(1 for x in page_bundles if len(x) == 0)
+            )
+            return page_bundles
+
+        def publish_pages():
+            while True:
+                exported_page = queue_get(exported_pages, stop)
+                if exported_page is None:
+                    return
+                end_cursor, number, entity_ids, page_bundles = exported_page
+                result["state"] = self._publish_page(
+                    result["state"], step, end_cursor, number, entity_ids, page_bundles
+                )
+                self._update_progress(bar, result["state"]["number"])
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor, (
+            self._progress_bar(global_count)
+            if self.partition is None
+            else progressbar.NullBar()
+        ) as bar:
+            lister = PipelineStage(list_pages, stop)
+            publisher = PipelineStage(publish_pages, stop)
+            lister.start()
+            publisher.start()
+            try:
+                while True:
+                    page = queue_get(pages, stop)
+                    if page is None:
+                        queue_put(exported_pages, None, stop)
+                        break
+                    end_cursor, entities = page
+                    number = len(entities)
+                    if len(published_ids) > 0:
+                        entities = [x for x in entities if x["id"] not in published_ids]
+                        published_ids = set()
+                    # Export the entities of the page in parallel, or the whole page
+                    if page_export is not None:
+                        page_bundles = future_results(
+                            executor.submit(timed_page_export, entities)
+                        )
+                    else:
+                        page_bundles = executor.map(timed_export, entities)
+                    queue_put(
+                        exported_pages,
+                        (end_cursor, number, [x["id"] for x in entities], page_bundles),
+                        stop,
                     )
-                    bar.update(
-                        state["number"]
-                        if state["number"] <= count["pagination"]["globalCount"]
-                        else count["pagination"]["globalCount"]
+                publisher.join()
+            except PipelineStopped:
+                pass
+            finally:
+                stop.set()
+                lister.join()
+                publisher.join()
+            for stage in [lister, publisher]:
+                if stage.error is not None:
+                    raise stage.error
+        self._print_sent()
+        self._write_report(step)
+        return result["state"]
+
+    def _migrate_deferred_relations(self, state):
+        global_count = state["number"] + self.deferred_relations.count()
+        self._begin_step(4)
+        with self._progress_bar(global_count) as bar:
+            while True:
+                relations = self.deferred_relations.drain(100)
+                if len(relations) == 0:
+                    break
+                state = self._publish_page(
+                    state,
+                    4,
+                    None,
+                    len(relations),
+                    [x[0] for x in relations],
+                    [x[1] for x in relations],
+                )
+                self._update_progress(bar, state["number"])
+        self.deferred_relations.clear_emitted()
+        self._print_sent()
+        self._write_report(4)
+        return state
+
+    def _steps(self):
+        return [
+            (
+                1,
+                "STEP 1: MIGRATION OF STIX DOMAIN OBJECTS (except containers)",
+                self.opencti_api_client.stix_domain_entity.list,
+                {
+                    "customAttributes": self._bulk_export_attributes(
+                        [x for x in BULK_EXPORT_TYPES if x not in ["report", "note"]]
                     )
+                },
+                self._export_stix_domain_entity,
+            ),
+            (
+                2,
+                "STEP 2: MIGRATION OF STIX CYBER OBSERVABLES",
+                self.opencti_api_client.stix_observable.list,
+                {},
+                self._export_stix_observable,
+            ),
+            (
+                3,
+                "STEP 3: MIGRATION OF STIX CORE RELATIONSHIPS",
+                self.opencti_api_client.stix_relation.list,
+                {"customAttributes": """
+                        id
+                    """},
+                self._export_stix_relation,
+            ),
+            # The relations are listed once, this step only sends the deferred ones
+            (
+                4,
+                "STEP 4: MIGRATION OF STIX CORE RELATIONSHIPS TO STIX CORE RELATIONSHIPS",
+                None,
+                None,
+                None,
+            ),
+            (
+                5,
+                "STEP 5: MIGRATION OF CONTAINERS",
+                self.opencti_api_client.stix_domain_entity.list,
+                {
+                    "types": ["Report", "Note"],
+                    "customAttributes": self._bulk_export_attributes(
+                        ["report", "note"]
+                    ),
+                },
+                self._export_container,
+            ),
+        ]
 
-        # 4. MIGRATION OF STIX CORE RELATIONSHIPS TO STIX CORE RELATIONSHIPS
-        if state["step"] == 3:
-            state = self.set_state({"step": 4, "after": None, "number": 0})
-        if state["step"] == 4:
-            print(" ")
+    def _time_range_filters(self, time_range):
+        filters = []
+        if time_range[0] is not None:
+            filters.append(
+                {"key": "created_at", "values": [time_range[0]], "operator": "gte"}
+            )
+        if time_range[1] is not None:
+            filters.append(
+                {"key": "created_at", "values": [time_range[1]], "operator": "lt"}
+            )
+        return filters
+
+    def _time_ranges(self, list_function, list_arguments, partitions):
+        list_arguments = dict(
+            list_arguments,
+            customAttributes="""
+                id
+                created_at
+            """,
+        )
+        first = list_function(
+            first=1, orderBy="created_at", orderMode="asc", **list_arguments
+        )
+        last = list_function(
+            first=1, orderBy="created_at", orderMode="desc", **list_arguments
+        )
+        if len(first) == 0 or len(last) == 0:
+            return [[None, None]]
+        start_date = dateutil.parser.parse(first[0]["created_at"])
+        end_date = dateutil.parser.parse(last[0]["created_at"])
+        interval = (end_date - start_date) / partitions
+        if interval.total_seconds() <= 0:
+            return [[None, None]]
+        # The first and last ranges are open so nothing is left outside of the partitions
+        boundaries = [
+            (start_date + interval * i).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+            for i in range(1, partitions)
+        ]
+        return [
+            [
+                None if i == 0 else boundaries[i - 1],
+                boundaries[i] if i < partitions - 1 else None,
+            ]
+            for i in range(partitions)
+        ]
+
+    def _format_date(self, date):
+        if date.tzinfo is not None:
+            date = date.astimezone(datetime.timezone.utc)
+        return date.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+    def _now(self):
+        # The mark is moved back to cover the writes in flight and the clock skew
+        overlap = float(self.config.get("opencti_migration_delta_overlap", 300))
+        return self._format_date(
+            datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(seconds=overlap)
+        )
+
+    def _high_water_mark(self):
+        return self.store.get_state("high-water-mark") or {}
+
+    def _set_high_water_mark(self, high_water_mark):
+        return self.store.set_state("high-water-mark", high_water_mark)
+
+    def _begin_high_water_mark(self, state):
+        # The next mark is the start of the first run of the migration
+        high_water_mark = self._high_water_mark()
+        if state["step"] is None and "next" not in high_water_mark:
+            self._set_high_water_mark(dict(high_water_mark, next=self._now()))
+
+    def _end_high_water_mark(self):
+        high_water_mark = self._high_water_mark()
+        if "next" in high_water_mark:
+            self._set_high_water_mark({"mark": high_water_mark["next"]})
+            print("High-water mark: " + high_water_mark["next"])
+
+    def _migrate_steps(self, state, since=None):
+        for step, title, list_function, list_arguments, export in self._steps():
+            if state["step"] is not None and state["step"] < step:
+                state = self.set_state({"step": step, "after": None, "number": 0})
+            if state["step"] is None or state["step"] == step:
+                print(" ")
+                print(title)
+                print(" ")
+                if list_function is None:
+                    state = self._migrate_deferred_relations(state)
+                else:
+                    state = self._migrate_step(
+                        state,
+                        step,
+                        list_function,
+                        list_arguments,
+                        export,
+                        since=since,
+                    )
+        return state
+
+    def start(self):
+        if self.partitions > 1:
+            return self.start_partitioned()
+        state = self.get_state()
+        if state["step"] is not None:
             print(
-                "STEP 4: MIGRATION OF STIX CORE RELATIONSHIPS TO STIX CORE RELATIONSHIPS"
+                "A current state has been found, resuming to step "
+                + str(state["step"])
+                + " with cursor "
+                + str(state["after"])
             )
+        self._begin_high_water_mark(state)
+        self._migrate_steps(state)
+        self._end_high_water_mark()
+        self._close()
+
+    def start_delta(self, since=None, continuous=False):
+        interval = float(self.config.get("opencti_migration_delta_interval", 300))
+        while True:
+            state = self.get_state()
+            high_water_mark = self._high_water_mark()
+            if state["step"] is not None and "since" in high_water_mark:
+                print(
+                    "A current delta has been found, resuming to step "
+                    + str(state["step"])
+                    + " with cursor "
+                    + str(state["after"])
+                )
+            else:
+                if since is not None:
+                    since = self._format_date(dateutil.parser.parse(since))
+                since = since or high_water_mark.get("mark")
+                if since is None:
+                    raise ValueError(
+                        "No high-water mark found, complete the migration or use --since"
+                    )
+                high_water_mark = {"since": since, "next": self._now()}
+                self._set_high_water_mark(high_water_mark)
             print(" ")
-            data = {"pagination": {"hasNextPage": True, "endCursor": state["after"]}}
-            count = self.opencti_api_client.stix_relation.list(
-                first=1,
-                withPagination=True,
-                customAttributes="""
-                    id
-                """,
-                orderBy="created_at",
-                orderMode="asc",
+            print("DELTA OF THE CHANGES SINCE " + high_water_mark["since"])
+            self._migrate_steps(state, high_water_mark["since"])
+            self._end_high_water_mark()
+            # The next delta starts from the first step with the new mark
+            self.set_state({"step": None, "after": None, "number": 0})
+            if not continuous:
+                break
+            since = None
+            time.sleep(interval)
+        self._close()
+
+    def start_partitioned(self):
+        state = self.get_state()
+        if state["step"] is not None:
+            print(
+                "A current state has been found, resuming to step "
+                + str(state["step"])
+                + " with "
+                + str(len(state["ranges"]))
+                + " partitions"
             )
-            with progressbar.ProgressBar(
-                max_value=count["pagination"]["globalCount"]
-            ) as bar:
-                while data["pagination"]["hasNextPage"]:
-                    after = data["pagination"]["endCursor"]
-                    data = self.opencti_api_client.stix_relation.list(
-                        first=100,
-                        after=after,
-                        withPagination=True,
-                        customAttributes="""
-                            id
-                        """,
-                        orderBy="created_at",
-                        orderMode="asc",
-                    )
-                    local_number = 0
-                    for stix_relation in data["entities"]:
-                        if stix_relation["from"]["stix_id_key"].startswith(
-                            "relationship"
-                        ) or stix_relation["to"]["stix_id_key"].startswith(
-                            "relationship"
-                        ):
-                            bundle_objects = (
-                                self.opencti_api_client.stix_relation.to_stix2(
-                                    id=stix_relation["id"]
-                                )
+        self._begin_high_water_mark(state)
+        context = multiprocessing.get_context("spawn")
+        for step, title, list_function, list_arguments, export in self._steps():
+            if state["step"] is None or state["step"] < step:
+                # The ranges are kept in the state so a resume uses the same partitions
+                state = self.set_state(
+                    {
+                        "step": step,
+                        "after": None,
+                        "number": 0,
+                        "ranges": (
+                            self._time_ranges(
+                                list_function, list_arguments, self.partitions
                             )
-                            bundle = {"type": "bundle", "objects": bundle_objects}
-                            self._send_bundle(json.dumps(bundle))
-                        local_number += 1
-                    state = self.set_state(
-                        {
-                            "step": 4,
-                            "after": after,
-                            "number": state["number"] + local_number,
-                        }
-                    )
-                    bar.update(
-                        state["number"]
-                        if state["number"] <= count["pagination"]["globalCount"]
-                        else count["pagination"]["globalCount"]
+                            if list_function is not None
+                            else []
+                        ),
+                    }
+                )
+            if state["step"] != step:
+                continue
+            print(" ")
+            print(title)
+            print(" ")
+            # The deferred relations of all the partitions are sent by this process
+            if list_function is None:
+                state = self._migrate_deferred_relations(state)
+                continue
+            count = list_function(first=1, withPagination=True, **list_arguments)
+            global_count = count["pagination"]["globalCount"]
+            processes = [
+                context.Process(
+                    target=migrate_partition, args=(step, partition, time_range)
+                )
+                for partition, time_range in enumerate(state["ranges"])
+            ]
+            for process in processes:
+                process.start()
+            # Each partition has its own state, the overall progress is their sum
+            with progressbar.ProgressBar(max_value=global_count) as bar:
+                while any(process.is_alive() for process in processes):
+                    time.sleep(1)
+                    self._update_progress(bar, self._partitions_number(state))
+                self._update_progress(bar, self._partitions_number(state))
+            # A step only ends once all its partitions are done
+            for process in processes:
+                process.join()
+                if process.exitcode != 0:
+                    raise ValueError(
+                        "Partition "
+                        + str(processes.index(process))
+                        + " of step "
+                        + str(step)
+                        + " failed"
                     )
+            state = self.set_state(dict(state, number=self._partitions_number(state)))
+        self._end_high_water_mark()
+        self._close()
+
+    def _partitions_number(self, state):
+        number = 0
+        for partition in range(len(state["ranges"])):
+            partition_state = self.store.get_state(self._state_key(partition))
+            if partition_state is not None and partition_state["step"] == state["step"]:
+                number += partition_state["number"]
+        return number
 
-        # 5. MIGRATION OF CONTAINERS
-        if state["step"] == 4:
-            state = self.set_state({"step": 5, "after": None, "number": 0})
-        if state["step"] == 5:
+    def start_partition(self, step, time_range):
+        state = self.get_state()
+        if state["step"] != step:
+            state = self.set_state({"step": step, "after": None, "number": 0})
+        if state.get("completed"):
+            return
+        for current_step, _, list_function, list_arguments, export in self._steps():
+            if current_step == step:
+                state = self._migrate_step(
+                    state, step, list_function, list_arguments, export, time_range
+                )
+        self.set_state(dict(state, completed=True))
+        self._close()
+
+    def start_from_cache(self):
+        state = self.get_state()
+        if state["step"] is not None:
+            print(
+                "A current state has been found, resuming to step "
+                + str(state["step"])
+                + " of the cache with record "
+                + str(state["after"])
+            )
+        for step in range(1, 6):
+            if state["step"] is not None and state["step"] < step:
+                state = self.set_state({"step": step, "after": None, "number": 0})
+            if state["step"] is not None and state["step"] != step:
+                continue
             print(" ")
-            print("STEP 5: MIGRATION OF CONTAINERS")
+            print("STEP " + str(step) + ": PUBLICATION OF THE CACHED BUNDLES")
             print(" ")
-            data = {"pagination": {"hasNextPage": True, "endCursor": state["after"]}}
-            count = self.opencti_api_client.stix_domain_entity.list(
-                types=["Report", "Note"],
-                first=1,
+            if step == 4:
+                state = self._migrate_deferred_relations(state)
+                continue
+            global_count = self.cache.count(step)
+            self._begin_step(step)
+            published_ids = self.store.get_published(self.state_key)
+            with self._progress_bar(global_count) as bar:
+                for records in self.cache.stream(step, state["after"], 100):
+                    number = len(records)
+                    last_sequence = records[-1][0]
+                    records = [x for x in records if x[1] not in published_ids]
+                    state = self._publish_page(
+                        state,
+                        step,
+                        last_sequence,
+                        number,
+                        [x[1] for x in records],
+                        [x[2] for x in records],
+                    )
+                    self._update_progress(bar, state["number"])
+            self._write_report(step)
+            if state["step"] is None:
+                state = self.set_state({"step": step, "after": None, "number": 0})
+        self._close()
+
+    def start_load_shards(self):
+        directory = self.config["opencti_migration_export_directory"]
+        rate = float(self.config.get("opencti_migration_load_rate", 0))
+        shards = []
+        for manifest_file in sorted(os.listdir(directory)):
+            if manifest_file.startswith("manifest-") and manifest_file.endswith(
+                ".json"
+            ):
+                with open(os.path.join(directory, manifest_file)) as manifest_handler:
+                    shards.extend(json.load(manifest_handler)["shards"])
+        # The steps are loaded in order, whatever the process which wrote them
+        shards.sort(key=lambda x: (x["step"], x["name"]))
+        state = self.get_state()
+        # The position is read once, the shard names are only ordered within a step
+        resume_index = 0
+        resume_line = 0
+        if state.get("shard") is not None:
+            shard_names = [x["name"] for x in shards]
+            if state["shard"] not in shard_names:
+                raise ValueError(
+                    "The shard " + state["shard"] + " is not in the export directory"
+                )
+            resume_index = shard_names.index(state["shard"])
+            resume_line = state["line"]
+            print(
+                "A current state has been found, resuming to shard "
+                + state["shard"]
+                + " at message "
+                + str(state["line"])
+            )
+        print(" ")
+        print("LOADING OF THE EXPORTED SHARDS")
+        print(" ")
+        global_count = sum(shard["messages"] for shard in shards)
+        started_at = time.monotonic()
+        sent = 0
+        with self._progress_bar(global_count) as bar:
+            for index in range(resume_index, len(shards)):
+                shard = shards[index]
+                line = resume_line if index == resume_index else 0
+                if self.metrics.step != shard["step"]:
+                    if self.metrics.step is not None:
+                        self._write_report(self.metrics.step)
+                    self.metrics.begin_step(shard["step"])
+                messages = read_shard(
+                    os.path.join(directory, shard["name"]), shard["messages"]
+                )
+                for number, message in enumerate(messages, 1):
+                    if number <= line:
+                        continue
+                    if rate > 0:
+                        # Messages are spread evenly at the configured rate
+                        delay = started_at + sent / rate - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    if self.flow_controller is not None:
+                        self.flow_controller.throttle()
+                    with self.metrics.time("publish"):
+                        self.publisher.publish(message)
+                    self.metrics.increment("messages")
+                    self.metrics.increment("bytes", len(message))
+                    sent += 1
+                    if number % 100 == 0 or number == shard["messages"]:
+                        with self.metrics.time("confirm"):
+                            self.publisher.wait_for_confirms()
+                        state = self.set_state(
+                            {
+                                "step": shard["step"],
+                                "after": None,
+                                "shard": shard["name"],
+                                "line": number,
+                                "number": state["number"] + number - line,
+                            }
+                        )
+                        line = number
+                        self._update_progress(bar, state["number"])
+        if self.metrics.step is not None:
+            self._write_report(self.metrics.step)
+        self._close()
+
+    def _relation_depths(self, relations):
+        # Number of relations between a relation and the entities it finally links
+        endpoints = {
+            x["stix_id_key"]: [
+                x[side]["stix_id_key"]
+                for side in ["from", "to"]
+                if x[side]["stix_id_key"].startswith("relationship")
+            ]
+            for x in relations
+        }
+        depths = {}
+
+        def depth(relation_id, visited):
+            if relation_id in depths:
+                return depths[relation_id]
+            if relation_id not in endpoints or relation_id in visited:
+                return 0
+            visited.add(relation_id)
+            result = max([1 + depth(x, visited) for x in endpoints[relation_id]] + [0])
+            depths[relation_id] = result
+            return result
+
+        return collections.Counter(depth(x, set()) for x in endpoints)
+
+    def _profile_step(self, step, list_function, list_arguments, export, sample_size):
+        list_latencies = []
+        started_at = time.perf_counter()
+        count = list_function(first=1, withPagination=True, **list_arguments)
+        list_latencies.append(time.perf_counter() - started_at)
+        global_count = count["pagination"]["globalCount"]
+        # The first entities of the step are sampled, in the order of the migration
+        entities = []
+        data = {"pagination": {"hasNextPage": True, "endCursor": None}}
+        while data["pagination"]["hasNextPage"] and len(entities) < sample_size:
+            started_at = time.perf_counter()
+            data = list_function(
+                first=min(100, sample_size - len(entities)),
+                after=data["pagination"]["endCursor"],
                 withPagination=True,
-                customAttributes="""
-                    id
-                    entity_type
-                """,
                 orderBy="created_at",
                 orderMode="asc",
+                **list_arguments
             )
-            with progressbar.ProgressBar(
-                max_value=count["pagination"]["globalCount"]
-            ) as bar:
-                while data["pagination"]["hasNextPage"]:
-                    after = data["pagination"]["endCursor"]
-                    data = self.opencti_api_client.stix_domain_entity.list(
-                        types=["Report", "Note"],
-                        first=100,
-                        after=after,
-                        withPagination=True,
-                        customAttributes="""
-                            id
-                            entity_type
-                        """,
-                        orderBy="created_at",
-                        orderMode="asc",
+            list_latencies.append(time.perf_counter() - started_at)
+            entities.extend(data["entities"])
+
+        def timed_export(entity):
+            started_at = time.perf_counter()
+            bundles = export(entity)
+            return bundles, time.perf_counter() - started_at
+
+        def timed_page_export(page_entities):
+            started_at = time.perf_counter()
+            page_bundles = page_export(page_entities)
+            # The latency of each entity is its share of the page
+            duration = (time.perf_counter() - started_at) / max(len(page_entities), 1)
+            return [(bundles, duration) for bundles in page_bundles]
+
+        # Exported with the configured workers, as during the migration
+        page_export = self._page_export(step)
+        started_at = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            if page_export is not None:
+                exported = [
+                    x
+                    for page_exported in executor.map(
+                        timed_page_export,
+                        [
+                            entities[page : page + 100]
+                            for page in range(0, len(entities), 100)
+                        ],
                     )
-                    local_number = 0
-                    for stix_domain_entity in data["entities"]:
-                        bundle = self.opencti_api_client.stix2.export_entity(
-                            stix_domain_entity["entity_type"],
-                            stix_domain_entity["id"],
+                    for x in page_exported
+                ]
+            else:
+                exported = list(executor.map(timed_export, entities))
+        export_duration = time.perf_counter() - started_at
+
+        # Messages of the sample, aggregated and encoded as during the migration
+        message_sizes = []
+        encode_duration = []
+
+        def send(bundle, callback, serialize_duration):
+            started_at = time.perf_counter()
+            message_sizes.append(len(self._encode_message(bundle)))
+            encode_duration.append(
+                serialize_duration + time.perf_counter() - started_at
+            )
+
+        bundle_aggregator = BundleAggregator(
+            send,
+            self.bundle_aggregator.max_objects,
+            self.bundle_aggregator.max_size,
+            (
+                SeenObjects(self.seen_objects.max_memory)
+                if self.seen_objects is not None
+                else None
+            ),
+        )
+        for page in range(0, len(exported), 100):
+            for bundles, _ in exported[page : page + 100]:
+                for bundle in bundles:
+                    bundle_aggregator.add(bundle)
+            bundle_aggregator.flush()
+
+        sampled = max(len(entities), 1)
+        ratio = global_count / sampled
+        pages = -(-global_count // 100)
+        sampled_pages = max(-(-len(entities) // 100), 1)
+        # The slowest stage of the pipeline gives the duration of a page
+        page_duration = max(
+            sum(list_latencies[1:]) / max(len(list_latencies) - 1, 1),
+            export_duration / sampled_pages,
+            sum(encode_duration) / sampled_pages,
+        )
+        profile = {
+            "step": step,
+            "count": global_count,
+            "sampled": len(entities),
+            "entity_types": {
+                entity_type: round(number * ratio)
+                for entity_type, number in collections.Counter(
+                    x.get("entity_type") for x in entities
+                ).most_common()
+            },
+            "skipped": round(sum(1 for x in exported if len(x[0]) == 0) * ratio),
+            "objects_per_entity": sum(
+                len(bundle["objects"]) for x in exported for bundle in x[0]
+            )
+            / sampled,
+            "bundle_bytes": summarize(
+                [
+                    sum(len(json_dumps(bundle)) for bundle in x[0])
+                    for x in exported
+                    if len(x[0]) > 0
+                ]
+            ),
+            "message_bytes": summarize(message_sizes),
+            "list_latency": summarize(list_latencies),
+            "export_latency": summarize([x[1] for x in exported]),
+            "estimated_messages": round(len(message_sizes) * ratio),
+            "estimated_bytes": round(sum(message_sizes) * ratio),
+            "estimated_seconds": pages * page_duration / max(self.partitions, 1),
+        }
+        if step == 2:
+            profile["indicators_per_observable"] = dict(
+                sorted(
+                    collections.Counter(
+                        len(x.get("indicatorsIds") or []) for x in entities
+                    ).items()
+                )
+            )
+        if step == 3:
+            profile["relation_depths"] = dict(
+                sorted(self._relation_depths(entities).items())
+            )
+        return profile
+
+    def start_profile(self):
+        sample_size = int(self.config.get("opencti_migration_profile_sample", 1000))
+        profiles = []
+        for step, title, list_function, list_arguments, export in self._steps():
+            # The relations of step 4 are listed and sampled in step 3
+            if list_function is None:
+                continue
+            print(" ")
+            print(title)
+            print(" ")
+            profile = self._profile_step(
+                step, list_function, list_arguments, export, sample_size
+            )
+            profiles.append(profile)
+            print(
+                "Entities: "
+                + str(profile["count"])
+                + " (sampled: "
+                + str(profile["sampled"])
+                + ", skipped: "
+                + str(profile["skipped"])
+                + ")"
+            )
+            for entity_type, number in profile["entity_types"].items():
+                print("  " + str(entity_type) + ": " + str(number))
+            for key in ["indicators_per_observable", "relation_depths"]:
+                if key in profile:
+                    print(key.replace("_", " ").capitalize() + ": " + str(profile[key]))
+            for key in ["list_latency", "export_latency"]:
+                if profile[key] is not None:
+                    print(
+                        key.replace("_", " ").capitalize()
+                        + ": p50 %.3fs, p95 %.3fs, max %.3fs"
+                        % (
+                            profile[key]["p50"],
+                            profile[key]["p95"],
+                            profile[key]["max"],
                         )
-                        bundle_objects = copy.deepcopy(bundle["objects"])
-                        bundle["objects"] = []
-                        for bundle_object in bundle_objects:
-                            if "labels" in bundle_object:
-                                del bundle_object["labels"]
-                            bundle["objects"].append(bundle_object)
-                        self._send_bundle(json.dumps(bundle))
-                        local_number += 1
-                    state = self.set_state(
-                        {
-                            "step": 5,
-                            "after": after,
-                            "number": state["number"] + local_number,
-                        }
-                    )
-                    bar.update(
-                        state["number"]
-                        if state["number"] <= count["pagination"]["globalCount"]
-                        else count["pagination"]["globalCount"]
                     )
+            print(
+                "Estimated messages: %d, bytes: %d, duration: %ds"
+                % (
+                    profile["estimated_messages"],
+                    profile["estimated_bytes"],
+                    profile["estimated_seconds"],
+                )
+            )
+        total = {
+            "workers": self.workers,
+            "partitions": self.partitions,
+            "bundle_max_objects": self.bundle_aggregator.max_objects,
+            "bundle_max_size": self.bundle_aggregator.max_size,
+            "estimated_messages": sum(x["estimated_messages"] for x in profiles),
+            "estimated_bytes": sum(x["estimated_bytes"] for x in profiles),
+            "estimated_seconds": sum(x["estimated_seconds"] for x in profiles),
+        }
+        print(" ")
+        print(
+            "TOTAL: %d messages, %d bytes, %s with %d workers and %d partitions"
+            % (
+                total["estimated_messages"],
+                total["estimated_bytes"],
+                datetime.timedelta(seconds=round(total["estimated_seconds"])),
+                self.workers,
+                self.partitions,
+            )
+        )
+        with open(
+            os.path.join(self.report_directory, "profile.json"), "w"
+        ) as profile_file_handler:
+            json.dump(dict(total, steps=profiles), profile_file_handler, indent=2)
+
+
+def migrate_partition(step, partition, time_range):
+    # The progress of a partition is only reported through its state
+    sys.stdout = open(os.devnull, "w")
+    Migrate(partition).start_partition(step, time_range)
 
 
 if __name__ == "__main__":
-    migrate_instance = Migrate()
-    migrate_instance.start()
+    parser = argparse.ArgumentParser(description="OpenCTI 3.3.2 to 4.X.X migration")
+    parser.add_argument(
+        "--from-cache",
+        action="store_true",
+        help="publish the bundles of the export cache without the V3 API",
+    )
+    parser.add_argument(
+        "--load-shards",
+        action="store_true",
+        help="publish the shards of the export directory without the V3 API",
+    )
+    parser.add_argument(
+        "--since",
+        nargs="?",
+        const="",
+        metavar="DATE",
+        help="migrate the changes since DATE, or since the high-water mark",
+    )
+    parser.add_argument(
+        "--continuous",
+        action="store_true",
+        help="migrate the changes since the high-water mark again and again",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="sample the V3 data and estimate the size and duration of the migration",
+    )
+    args = parser.parse_args()
+    if args.profile:
+        migrate_instance = Migrate(profile=True)
+        migrate_instance.start_profile()
+    elif args.since is not None or args.continuous:
+        migrate_instance = Migrate(delta=True)
+        migrate_instance.start_delta(args.since or None, args.continuous)
+    elif args.load_shards:
+        migrate_instance = Migrate(load_shards=True)
+        migrate_instance.start_load_shards()
+    elif args.from_cache:
+        migrate_instance = Migrate(from_cache=True)
+        migrate_instance.start_from_cache()
+    else:
+        migrate_instance = Migrate()
+        migrate_instance.start()
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakes
+import migrate
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch, tmp_path):
+    for key in list(os.environ):
+        if key.startswith("OPENCTI"):
+            monkeypatch.delenv(key)
+    for key, value in fakes.CONFIG.items():
+        monkeypatch.setenv(key, value)
+    # The configuration, the state and the reports are kept next to the script
+    monkeypatch.setattr(migrate, "__file__", str(tmp_path / "migrate.py"))
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = fakes.FakeApi()
+    monkeypatch.setattr(migrate, "OpenCTIApiClient", api.client)
+    return api
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = fakes.FakeBroker()
+    monkeypatch.setattr(migrate.pika, "BlockingConnection", broker.connect)
+    monkeypatch.setattr(migrate.pika, "SelectConnection", broker.select_connection())
+    return broker
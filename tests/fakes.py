@@ -0,0 +1,489 @@
+import json
+import base64
+import collections
+import heapq
+import itertools
+import threading
+import time
+import types
+
+import pika
+
+# Configuration of a migration, given through the environment
+CONFIG = {
+    "OPENCTI_V3_URL": "http://opencti.v3",
+    "OPENCTI_V3_TOKEN": "token",
+    "OPENCTI_V4_IMPORT_FILE_STIX_CONNECTOR_ID": "connector",
+    "OPENCTI_V4_RABBITMQ_HOSTNAME": "rabbitmq.v4",
+    "OPENCTI_V4_RABBITMQ_PORT": "5672",
+    "OPENCTI_V4_RABBITMQ_USER": "user",
+    "OPENCTI_V4_RABBITMQ_PASSWORD": "password",
+}
+
+SDO_TYPES = ["malware", "report", "organization", "note", "threat-actor"]
+
+
+def entity(number, entity_type):
+    return {
+        "id": "v3-" + entity_type + "-" + str(number),
+        "entity_type": entity_type,
+        "stix_id_key": entity_type + "--" + str(number),
+        "created_at": "2020-01-%02dT00:00:00.000Z" % (number % 28 + 1),
+        "updated_at": "2020-02-01T00:00:00.000Z",
+    }
+
+
+def stix_domain_entities(number):
+    return [entity(x, SDO_TYPES[x % len(SDO_TYPES)]) for x in range(number)]
+
+
+def stix_observables(number):
+    return [
+        dict(
+            entity(x, "ipv4-addr"),
+            observable_value="10.0.0." + str(x),
+            description="",
+            createdByRef=None,
+            markingDefinitions=[],
+            tags=[],
+            externalReferences=[],
+            indicatorsIds=["indicator--" + str(x)] if x % 3 == 0 else [],
+        )
+        for x in range(number)
+    ]
+
+
+def stix_relations(number):
+    relations = []
+    for x in range(number):
+        relation = entity(x, "relationship")
+        relation["from"] = {"id": "a", "entity_type": "malware"}
+        relation["from"]["stix_id_key"] = "malware--" + str(x)
+        relation["to"] = {"id": "b", "entity_type": "threat-actor"}
+        # Every fourth relation points to the previous relation
+        relation["to"]["stix_id_key"] = (
+            "relationship--" + str(x - 1)
+            if x > 0 and x % 4 == 0
+            else "threat-actor--" + str(x)
+        )
+        relations.append(relation)
+    return relations
+
+
+def shared_references():
+    return [
+        {"id": "identity--author", "type": "identity", "name": "Author"},
+        {"id": "marking-definition--tlp", "type": "marking-definition"},
+    ]
+
+
+class FakeApi:
+    def __init__(self, number=50, latency=0):
+        self.latency = latency
+        self.stix_domain_entities = stix_domain_entities(number)
+        self.stix_observables = stix_observables(number)
+        self.stix_relations = stix_relations(number)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.concurrency = 0
+        self.max_concurrency = 0
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+            self.concurrency += 1
+            self.max_concurrency = max(self.max_concurrency, self.concurrency)
+        try:
+            if self.latency > 0:
+                time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.concurrency -= 1
+
+    def client(self, *args, **kwargs):
+        return FakeClient(self)
+
+
+class FakeListing:
+    def __init__(self, api, entities):
+        self.api = api
+        self.entities = entities
+        self.properties = " id "
+
+    def list(
+        self,
+        first=500,
+        after=None,
+        types=None,
+        filters=None,
+        orderBy=None,
+        orderMode=None,
+        withPagination=False,
+        **kwargs
+    ):
+        self.api.call()
+        entities = self.entities
+        if types is not None:
+            entities = [
+                x for x in entities if x["entity_type"] in [t.lower() for t in types]
+            ]
+        for listing_filter in filters or []:
+            key = listing_filter["key"]
+            value = listing_filter["values"][0]
+            operator = listing_filter.get("operator", "eq")
+            entities = [
+                x
+                for x in entities
+                if {
+                    "eq": x[key] == value,
+                    "gt": x[key] > value,
+                    "gte": x[key] >= value,
+                    "lt": x[key] < value,
+                }[operator]
+            ]
+        if orderBy is not None:
+            entities = sorted(
+                entities, key=lambda x: x[orderBy], reverse=orderMode == "desc"
+            )
+        start = int(after) if after else 0
+        page = [dict(x) for x in entities[start : start + first]]
+        end = start + len(page)
+        data = {
+            "entities": page,
+            "pagination": {
+                "hasNextPage": end < len(entities),
+                "endCursor": str(end),
+                "globalCount": len(entities),
+            },
+        }
+        return data if withPagination else data["entities"]
+
+
+class FakeRelationListing(FakeListing):
+    def to_stix2(self, id=None, entity=None, **kwargs):
+        if entity is None:
+            self.api.call()
+            entity = [x for x in self.entities if x["id"] == id][0]
+        return [
+            {
+                "id": entity["stix_id_key"],
+                "type": "relationship",
+                "relationship_type": "uses",
+                "source_ref": entity["from"]["stix_id_key"],
+                "target_ref": entity["to"]["stix_id_key"],
+            }
+        ]
+
+
+class FakeEntity:
+    properties = " id "
+
+    def to_stix2(self, entity=None, **kwargs):
+        return shared_references() + [
+            {
+                "id": entity["stix_id_key"],
+                "type": entity["entity_type"],
+                "labels": ["label"],
+                "created_by_ref": "identity--author",
+                "object_marking_refs": ["marking-definition--tlp"],
+            }
+        ]
+
+
+class FakeStix2:
+    def __init__(self, api):
+        self.api = api
+
+    def export_entity(self, entity_type, entity_id, mode="simple"):
+        self.api.call()
+        return {
+            "type": "bundle",
+            "id": "bundle--" + entity_id,
+            "objects": shared_references()
+            + [
+                {
+                    "id": entity_type + "--" + entity_id.split("-")[-1],
+                    "type": entity_type,
+                    "labels": ["label"],
+                    "created_by_ref": "identity--author",
+                    "object_marking_refs": ["marking-definition--tlp"],
+                }
+            ],
+        }
+
+    def prepare_export(self, entity, stix_object, mode="simple", **kwargs):
+        return [stix_object]
+
+
+class FakeClient:
+    def __init__(self, api):
+        for name in [
+            "identity",
+            "threat_actor",
+            "intrusion_set",
+            "campaign",
+            "incident",
+            "malware",
+            "tool",
+            "vulnerability",
+            "attack_pattern",
+            "course_of_action",
+            "indicator",
+            "opinion",
+            "report",
+            "note",
+        ]:
+            setattr(self, name, FakeEntity())
+        self.stix_domain_entity = FakeListing(api, api.stix_domain_entities)
+        self.stix_observable = FakeListing(api, api.stix_observables)
+        self.stix_relation = FakeRelationListing(api, api.stix_relations)
+        self.stix2 = FakeStix2(api)
+
+
+class FakeBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []
+        self.queue_depth = 0
+        # Number of messages accepted before the channel fails, None for no failure
+        self.fail_after = None
+        # Publisher confirms: delay of the confirmations, number of nacks and of
+        # lost confirmations by message body
+        self.confirm_latency = 0
+        self.nacks = collections.Counter()
+        self.lost = collections.Counter()
+        self.unconfirmed = 0
+        self.max_unconfirmed = 0
+
+    def connect(self, parameters=None):
+        return FakeConnection(self)
+
+    def select_connection(self):
+        broker = self
+
+        class Connection(FakeSelectConnection):
+            def __init__(self, *args, **kwargs):
+                super().__init__(broker, *args, **kwargs)
+
+        return Connection
+
+    def objects(self):
+        return [x for message in self.messages for x in decode(message)["objects"]]
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return FakeChannel(self.broker)
+
+    def process_data_events(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeChannel:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        with self.broker.lock:
+            if self.broker.fail_after is not None:
+                if self.broker.fail_after == 0:
+                    raise IOError("Channel closed")
+                self.broker.fail_after -= 1
+            self.broker.messages.append(body)
+
+    def confirm_delivery(self, *args, **kwargs):
+        pass
+
+    def queue_declare(self, queue, passive=False):
+        return types.SimpleNamespace(
+            method=types.SimpleNamespace(message_count=self.broker.queue_depth)
+        )
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeIOLoop:
+    # Runs the callbacks and the timers in the thread calling start
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.stopped = False
+
+    def add_callback_threadsafe(self, callback):
+        self.call_later(0, callback)
+
+    def call_later(self, delay, callback):
+        with self.condition:
+            heapq.heappush(
+                self.timers, (time.monotonic() + delay, next(self.sequence), callback)
+            )
+            self.condition.notify()
+
+    def start(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    now = time.monotonic()
+                    if len(self.timers) > 0 and self.timers[0][0] <= now:
+                        break
+                    self.condition.wait(
+                        self.timers[0][0] - now if len(self.timers) > 0 else None
+                    )
+                if self.stopped:
+                    return
+                callback = heapq.heappop(self.timers)[2]
+            callback()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+class FakeSelectConnection:
+    @staticmethod
+    def create_default_ioloop():
+        return FakeIOLoop()
+
+    def __init__(
+        self,
+        broker,
+        parameters=None,
+        on_open_callback=None,
+        on_open_error_callback=None,
+        on_close_callback=None,
+        custom_ioloop=None,
+    ):
+        self.broker = broker
+        self.ioloop = custom_ioloop
+        self.on_close_callback = on_close_callback
+        self.is_open = True
+        self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self))
+
+    def channel(self, on_open_callback=None):
+        channel = FakeConfirmChannel(self.broker, self.ioloop)
+        self.ioloop.add_callback_threadsafe(lambda: on_open_callback(channel))
+
+    def close(self):
+        self.is_open = False
+        self.ioloop.add_callback_threadsafe(lambda: self.on_close_callback(self, None))
+
+
+class FakeConfirmChannel:
+    def __init__(self, broker, ioloop):
+        self.broker = broker
+        self.ioloop = ioloop
+        self.is_open = True
+        self.delivery_tag = 0
+        self.ack_nack_callback = None
+
+    def confirm_delivery(self, ack_nack_callback=None):
+        self.ack_nack_callback = ack_nack_callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.delivery_tag += 1
+        with self.broker.lock:
+            self.broker.messages.append(body)
+            if self.broker.lost[body] > 0:
+                self.broker.lost[body] -= 1
+                return
+            self.broker.unconfirmed += 1
+            self.broker.max_unconfirmed = max(
+                self.broker.max_unconfirmed, self.broker.unconfirmed
+            )
+            if self.broker.nacks[body] > 0:
+                self.broker.nacks[body] -= 1
+                method = pika.spec.Basic.Nack(delivery_tag=self.delivery_tag)
+            else:
+                method = pika.spec.Basic.Ack(delivery_tag=self.delivery_tag)
+        self.ioloop.call_later(
+            self.broker.confirm_latency, lambda: self._confirm(method)
+        )
+
+    def _confirm(self, method):
+        with self.broker.lock:
+            self.broker.unconfirmed -= 1
+        self.ack_nack_callback(types.SimpleNamespace(method=method))
+
+
+def decode(message):
+    # The bundle of a message of the import connector
+    return json.loads(base64.b64decode(json.loads(message)["content"]))
+
+
+class FakeElasticsearch:
+    # Relations index scanned by sliced scrolls, entity ids looked up by aggregation
+    def __init__(self, relations, entity_ids, statuses=None):
+        self.lock = threading.Lock()
+        self.relations = relations
+        self.entity_ids = entity_ids
+        # Status of the deletion by relation id, 200 otherwise
+        self.statuses = statuses or {}
+        self.scrolls = {}
+        self.cleared_scrolls = []
+        self.lookups = []
+        self.deleted = set()
+
+    def search(self, index, body, scroll=None):
+        if "aggs" in body:
+            grakn_ids = body["query"]["terms"]["grakn_id.keyword"]
+            with self.lock:
+                self.lookups.append(grakn_ids)
+            return {
+                "aggregations": {
+                    "grakn_ids": {
+                        "buckets": [
+                            {"key": x, "doc_count": 1}
+                            for x in grakn_ids
+                            if x in self.entity_ids
+                        ]
+                    }
+                }
+            }
+        scroll_slice = body.get("slice", {"id": 0, "max": 1})
+        hits = [
+            x
+            for i, x in enumerate(self.relations)
+            if i % scroll_slice["max"] == scroll_slice["id"]
+        ]
+        scroll_id = "scroll-" + str(scroll_slice["id"])
+        with self.lock:
+            self.scrolls[scroll_id] = (hits, body["size"], body["size"])
+        return {"_scroll_id": scroll_id, "hits": {"hits": hits[: body["size"]]}}
+
+    def scroll(self, scroll_id, scroll):
+        with self.lock:
+            hits, position, size = self.scrolls[scroll_id]
+            self.scrolls[scroll_id] = (hits, position + size, size)
+        return {
+            "_scroll_id": scroll_id,
+            "hits": {"hits": hits[position : position + size]},
+        }
+
+    def clear_scroll(self, scroll_id):
+        with self.lock:
+            self.cleared_scrolls.append(scroll_id)
+
+    def bulk(self, body):
+        items = []
+        with self.lock:
+            for action in body:
+                relation_id = action["delete"]["_id"]
+                status = self.statuses.get(relation_id, 200)
+                item = {"_id": relation_id, "status": status}
+                if status == 200:
+                    self.deleted.add(relation_id)
+                elif status != 404:
+                    item["error"] = {"type": "version_conflict_engine_exception"}
+                items.append({"delete": item})
+        return {"items": items}
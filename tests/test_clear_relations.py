@@ -0,0 +1,69 @@
+import clear_relations
+import fakes
+
+# Entities 0 to 199, every seventh one being missing
+ENTITY_IDS = set("V" + str(x) for x in range(200) if x % 7 != 0)
+
+
+def relations(number):
+    return [
+        {
+            "_index": "stix_relations",
+            "_id": "relation-" + str(x),
+            "_source": {
+                "connections": [
+                    {"grakn_id": "V" + str(x % 200)},
+                    {"grakn_id": "V" + str(x * 3 % 200)},
+                ]
+            },
+        }
+        for x in range(number)
+    ]
+
+
+def dangling_ids(relations):
+    return set(
+        x["_id"]
+        for x in relations
+        if any(y["grakn_id"] not in ENTITY_IDS for y in x["_source"]["connections"])
+    )
+
+
+def test_dry_run_only_reports(monkeypatch):
+    monkeypatch.setattr(clear_relations, "LOOKUP_SIZE", 50)
+    client = fakes.FakeElasticsearch(relations(1000), ENTITY_IDS)
+    report = clear_relations.RelationsCleaner(
+        client, slices=4, batch_size=100, dry_run=True
+    ).run()
+    assert client.deleted == set()
+    assert report["scanned"] == 1000
+    assert report["dangling"] == len(dangling_ids(client.relations))
+    assert report["deleted"] == 0
+    assert set(x["id"] for x in report["relations"]) == dangling_ids(client.relations)
+    assert set(report["missing_ids"]) == set("V" + str(x) for x in range(0, 200, 7))
+    # The ids are looked up by chunks, and each scroll is cleared
+    assert max(len(x) for x in client.lookups) <= 50
+    assert sorted(client.cleared_scrolls) == ["scroll-" + str(x) for x in range(4)]
+
+
+def test_dangling_relations_are_deleted():
+    client = fakes.FakeElasticsearch(relations(1000), ENTITY_IDS)
+    report = clear_relations.RelationsCleaner(client, slices=3, batch_size=64).run()
+    assert client.deleted == dangling_ids(client.relations)
+    assert report["deleted"] == len(client.deleted)
+    assert report["failed"] == 0
+
+
+def test_failed_deletions_are_reported():
+    # relation-0 is in conflict, relation-7 already deleted
+    client = fakes.FakeElasticsearch(
+        relations(100), ENTITY_IDS, {"relation-0": 409, "relation-7": 404}
+    )
+    report = clear_relations.RelationsCleaner(client, slices=1, batch_size=10).run()
+    assert report["failed"] == 1
+    assert report["errors"][0]["id"] == "relation-0"
+    assert report["deleted"] == report["dangling"] - 1
+    assert client.deleted == dangling_ids(client.relations) - {
+        "relation-0",
+        "relation-7",
+    }
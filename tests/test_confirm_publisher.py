@@ -0,0 +1,72 @@
+import pytest
+
+import migrate
+
+
+@pytest.fixture
+def publisher(monkeypatch, broker):
+    # The messages are sent again without waiting
+    monkeypatch.setattr(
+        migrate.RabbitMQConfirmPublisher, "_backoff", lambda self, attempt: 0.01
+    )
+    publishers = []
+
+    def create(window=10, timeout=5, max_retries=2):
+        publisher = migrate.RabbitMQConfirmPublisher(
+            None, "", "queue", window, timeout, max_retries
+        )
+        publishers.append(publisher)
+        return publisher
+
+    yield create
+    for publisher in publishers:
+        publisher.close()
+
+
+def publish(publisher, bodies):
+    confirmed = []
+    for body in bodies:
+        publisher.publish(body, lambda body=body: confirmed.append(body))
+    publisher.wait_for_confirms()
+    return confirmed
+
+
+def test_messages_are_confirmed(publisher, broker):
+    bodies = ["message-" + str(x) for x in range(20)]
+    assert sorted(publish(publisher(), bodies)) == sorted(bodies)
+    assert broker.messages == bodies
+
+
+def test_nacked_message_is_sent_again(publisher, broker):
+    broker.nacks["message-1"] = 1
+    confirm_publisher = publisher()
+    bodies = ["message-" + str(x) for x in range(3)]
+    assert sorted(publish(confirm_publisher, bodies)) == bodies
+    assert confirm_publisher.retries == 1
+    assert broker.messages.count("message-1") == 2
+
+
+def test_message_nacked_by_every_retry_fails(publisher, broker):
+    broker.nacks["message-1"] = float("inf")
+    confirm_publisher = publisher(max_retries=2)
+    with pytest.raises(ValueError):
+        publish(confirm_publisher, ["message-0", "message-1"])
+    assert broker.messages.count("message-1") == 3
+    # The failure is raised by the next publication too
+    with pytest.raises(ValueError):
+        confirm_publisher.publish("message-2")
+
+
+def test_unconfirmed_message_is_sent_again_after_the_timeout(publisher, broker):
+    broker.lost["message-0"] = 1
+    confirm_publisher = publisher(timeout=0.1)
+    assert publish(confirm_publisher, ["message-0"]) == ["message-0"]
+    assert confirm_publisher.retries == 1
+    assert broker.messages == ["message-0", "message-0"]
+
+
+def test_unconfirmed_messages_are_limited_by_the_window(publisher, broker):
+    broker.confirm_latency = 0.01
+    bodies = ["message-" + str(x) for x in range(12)]
+    assert sorted(publish(publisher(window=3), bodies)) == sorted(bodies)
+    assert broker.max_unconfirmed == 3
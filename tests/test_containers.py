@@ -0,0 +1,45 @@
+import uuid
+
+import migrate
+
+
+def report_bundle():
+    # The observed data has a new id on each export of pycti
+    observed_data = {
+        "id": "observed-data--" + str(uuid.uuid4()),
+        "type": "observed-data",
+        "number_observed": 50,
+        "objects": [
+            {"type": "ipv4-addr", "value": "10.0.0." + str(x)} for x in range(50)
+        ],
+    }
+    report = {
+        "id": "report--1",
+        "type": "report",
+        "object_refs": ["indicator--" + str(x) for x in range(100)]
+        + [observed_data["id"]],
+    }
+    return {"type": "bundle", "objects": [observed_data, report]}
+
+
+def test_split_container_has_the_same_ids_when_sent_again(monkeypatch, api, broker):
+    monkeypatch.setenv("OPENCTI_MIGRATION_CONTAINER_MAX_REFS", "10")
+    monkeypatch.setenv("OPENCTI_MIGRATION_CONTAINER_CHUNK_SIZE", "512")
+    migration = migrate.Migrate()
+    bundle = report_bundle()
+    bundles = migration._split_container(report_bundle())
+    assert bundles == migration._split_container(report_bundle())
+    parts = [x for y in bundles for x in y["objects"] if x["type"] == "observed-data"]
+    assert len(parts) > 1
+    assert len(set(x["id"] for x in parts)) == len(parts)
+    assert bundle["objects"][0]["id"] not in [x["id"] for x in parts]
+    assert [x for y in parts for x in y["objects"]] == bundle["objects"][0]["objects"]
+    refs = [
+        x
+        for y in bundles
+        for z in y["objects"]
+        if z["type"] == "report"
+        for x in z["object_refs"]
+    ]
+    assert refs == bundle["objects"][1]["object_refs"][:-1] + [x["id"] for x in parts]
+    migration._close()
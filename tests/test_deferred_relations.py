@@ -0,0 +1,112 @@
+import pytest
+
+import fakes
+import migrate
+
+
+def transactions(statements):
+    transaction = []
+    for statement in statements:
+        if statement == "COMMIT":
+            yield transaction
+            transaction = []
+        else:
+            transaction.append(statement)
+
+
+def test_relations_follow_the_relations_they_point_to(api, broker):
+    # Three pages, with relations listed before the relation they point to
+    api.stix_relations = fakes.stix_relations(250)
+    # A relation pointing to a missing relation is only sent by step 4
+    api.stix_relations[-1]["to"]["stix_id_key"] = "relationship--missing"
+    migration = migrate.Migrate()
+    statements = []
+    migration.store.connection.set_trace_callback(statements.append)
+    step, _, list_function, list_arguments, export = migration._steps()[2]
+    state = migration._migrate_step(
+        {"step": step, "after": None, "number": 0},
+        step,
+        list_function,
+        list_arguments,
+        export,
+    )
+    assert migration.deferred_relations.count() == 1
+    migration._migrate_deferred_relations(state)
+    migration._close()
+    sent_ids = []
+    for bundle_object in broker.objects():
+        if bundle_object["target_ref"] == "relationship--missing":
+            assert len(sent_ids) == 249
+        elif bundle_object["target_ref"].startswith("relationship--"):
+            assert bundle_object["target_ref"] in sent_ids
+        sent_ids.append(bundle_object["id"])
+    assert sorted(sent_ids) == sorted(x["stix_id_key"] for x in api.stix_relations)
+    # The changes of the deferred relations are committed with the state of a page
+    for transaction in transactions(statements):
+        if any(
+            x.startswith(("INSERT", "DELETE"))
+            and ("deferred_" in x or "INTO emitted_relations" in x)
+            for x in transaction
+        ):
+            assert any("INTO checkpoints" in x for x in transaction)
+    assert migration.deferred_relations.count() == 0
+    assert (
+        migration.store.connection.execute(
+            "SELECT COUNT(*) FROM emitted_relations"
+        ).fetchone()[0]
+        == 0
+    )
+
+
+def migrate_relations(state):
+    migration = migrate.Migrate()
+    if state is None:
+        state = migration.get_state()
+    if state["step"] is None:
+        state = {"step": 3, "after": None, "number": 0}
+    step, _, list_function, list_arguments, export = migration._steps()[2]
+    if state["step"] == step:
+        state = migration._migrate_step(
+            state, step, list_function, list_arguments, export
+        )
+        state = migration.set_state({"step": 4, "after": None, "number": 0})
+    migration._migrate_deferred_relations(state)
+    migration._close()
+
+
+def test_relations_are_sent_after_a_crash(monkeypatch, api, broker):
+    monkeypatch.setenv("OPENCTI_MIGRATION_BUNDLE_MAX_OBJECTS", "1")
+    api.stix_relations = fakes.stix_relations(250)
+    # The broker fails within the first page, after its deferred relations
+    broker.fail_after = 50
+    with pytest.raises(ValueError):
+        migrate_relations({"step": 3, "after": None, "number": 0})
+    broker.fail_after = None
+    migrate_relations(None)
+    sent_ids = set()
+    for bundle_object in broker.objects():
+        if bundle_object["target_ref"].startswith("relationship--"):
+            assert bundle_object["target_ref"] in sent_ids
+        sent_ids.add(bundle_object["id"])
+    assert sent_ids == set(x["stix_id_key"] for x in api.stix_relations)
+
+
+def test_partitions_resume_after_a_page_of_step_4(monkeypatch, api, broker):
+    monkeypatch.setenv("OPENCTI_MIGRATION_PARTITIONS", "2")
+    api.stix_relations = fakes.stix_relations(10)
+    api.stix_relations[-1]["to"]["stix_id_key"] = "relationship--missing"
+    migration = migrate.Migrate()
+    step, _, list_function, list_arguments, export = migration._steps()[2]
+    migration._migrate_step(
+        {"step": step, "after": None, "number": 0},
+        step,
+        list_function,
+        list_arguments,
+        export,
+    )
+    state = migration._migrate_deferred_relations(
+        migration.set_state({"step": 4, "after": None, "number": 0, "ranges": []})
+    )
+    assert state["ranges"] == []
+    assert migration.get_state() == state
+    migration._close()
@@ -0,0 +1,28 @@
+import migrate
+
+
+def test_delta_only_sends_the_entities_updated_since_the_mark(monkeypatch, api, broker):
+    marks = iter(["2020-03-01T00:00:00.000Z", "2020-04-01T00:00:00.000Z"])
+    monkeypatch.setattr(migrate.Migrate, "_now", lambda self: next(marks))
+    migration = migrate.Migrate()
+    migration.start()
+    assert migration._high_water_mark() == {"mark": "2020-03-01T00:00:00.000Z"}
+    updated = [
+        api.stix_domain_entities[0],
+        api.stix_domain_entities[1],
+        api.stix_observables[2],
+        api.stix_relations[3],
+    ]
+    for entity in updated:
+        entity["updated_at"] = "2020-03-02T00:00:00.000Z"
+    broker.messages = []
+    migration = migrate.Migrate(delta=True)
+    migration.start_delta()
+    # The authors and markings are sent again with the first entity of the delta
+    sent_ids = [
+        x["id"]
+        for x in broker.objects()
+        if x["type"] not in ["identity", "marking-definition"]
+    ]
+    assert sorted(sent_ids) == sorted(x["stix_id_key"] for x in updated)
+    assert migration._high_water_mark() == {"mark": "2020-04-01T00:00:00.000Z"}
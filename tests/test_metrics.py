@@ -0,0 +1,26 @@
+import time
+
+import migrate
+
+
+def test_encode_includes_the_serialization(monkeypatch, api, broker):
+    json_dumps = migrate.json_dumps
+
+    def slow_json_dumps(data):
+        time.sleep(0.002)
+        return json_dumps(data)
+
+    monkeypatch.setattr(migrate, "json_dumps", slow_json_dumps)
+    migration = migrate.Migrate()
+    step, _, list_function, list_arguments, export = migration._steps()[0]
+    migration._migrate_step(
+        {"step": step, "after": None, "number": 0},
+        step,
+        list_function,
+        list_arguments,
+        export,
+    )
+    migration._close()
+    histogram = migration.metrics.histograms[("encode", 1)]
+    assert sum(histogram["buckets"]) == migration.metrics.get("messages")
+    assert histogram["sum"] >= 0.002 * migration.metrics.get("objects")
@@ -0,0 +1,40 @@
+import migrate
+
+
+def migrate_observables():
+    # A migration of step 2 started again from the beginning
+    migration = migrate.Migrate()
+    step, _, list_function, list_arguments, export = migration._steps()[1]
+    migration._migrate_step(
+        {"step": step, "after": None, "number": 0},
+        step,
+        list_function,
+        list_arguments,
+        export,
+    )
+    migration._close()
+
+
+def test_published_objects_are_not_sent_again(monkeypatch, api, broker):
+    monkeypatch.setenv("OPENCTI_MIGRATION_REPLAY_SAFE", "true")
+    migrate_observables()
+    assert len(broker.objects()) > 0
+    broker.messages = []
+    migrate_observables()
+    assert broker.objects() == []
+    # An updated object has another digest
+    api.stix_observables[1]["description"] = "Updated"
+    migrate_observables()
+    assert [x["id"] for x in broker.objects()] == ["ipv4-addr--1"]
+    assert broker.objects()[0]["description"] == "Updated"
+
+
+def test_based_on_relations_have_the_same_ids(api, broker):
+    migrate_observables()
+    relations = [x for x in broker.objects() if x["type"] == "relationship"]
+    assert len(relations) == len(
+        [x for x in api.stix_observables if x["indicatorsIds"]]
+    )
+    broker.messages = []
+    migrate_observables()
+    assert [x for x in broker.objects() if x["type"] == "relationship"] == relations
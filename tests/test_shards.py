@@ -0,0 +1,92 @@
+import json
+import os
+
+import pytest
+
+import migrate
+
+
+def test_shard_is_read_back(tmp_path):
+    writer = migrate.ShardWriter(str(tmp_path), "main", 1024)
+    writer.begin_step(1)
+    messages = [os.urandom(64).hex().encode() for x in range(500)]
+    for message in messages:
+        writer.publish(message)
+    writer.wait_for_confirms()
+    # The last shard is not closed, as after a crash
+    shards = writer.manifest["shards"]
+    assert len(shards) > 1
+    assert [
+        x
+        for shard in shards
+        for x in migrate.read_shard(
+            os.path.join(str(tmp_path), shard["name"]), shard["messages"]
+        )
+    ] == messages
+
+
+def export_partitions(monkeypatch, tmp_path, partitions):
+    monkeypatch.setenv("OPENCTI_MIGRATION_SINK", "file")
+    monkeypatch.setenv("OPENCTI_MIGRATION_EXPORT_DIRECTORY", str(tmp_path / "export"))
+    monkeypatch.setenv("OPENCTI_MIGRATION_BUNDLE_MAX_OBJECTS", "1")
+    for partition in range(partitions):
+        migration = migrate.Migrate(partition=partition)
+        for step, _, list_function, list_arguments, export in migration._steps()[:2]:
+            time_range = migration._time_ranges(
+                list_function, list_arguments, partitions
+            )[partition]
+            migration._migrate_step(
+                {"step": step, "after": None, "number": 0},
+                step,
+                list_function,
+                list_arguments,
+                export,
+                time_range=time_range,
+            )
+        migration._close()
+    monkeypatch.delenv("OPENCTI_MIGRATION_SINK")
+    # The messages of each step, whatever the partition which exported them
+    directory = str(tmp_path / "export")
+    shards = {}
+    for partition in range(partitions):
+        manifest_file = os.path.join(
+            directory, "manifest-partition-" + str(partition) + ".json"
+        )
+        with open(manifest_file) as manifest_handler:
+            for shard in json.load(manifest_handler)["shards"]:
+                shards.setdefault(shard["step"], []).append(
+                    list(
+                        migrate.read_shard(
+                            os.path.join(directory, shard["name"]), shard["messages"]
+                        )
+                    )
+                )
+    return [shards[step] for step in sorted(shards)]
+
+
+def load_shards():
+    migration = migrate.Migrate(load_shards=True)
+    migration.start_load_shards()
+
+
+def test_partitioned_export_is_loaded_entirely(monkeypatch, tmp_path, api, broker):
+    steps = export_partitions(monkeypatch, tmp_path, 2)
+    assert [len(x) for x in steps] == [2, 2]
+    load_shards()
+    # The steps are loaded in order, each one with the shards of every partition
+    assert broker.messages == [x for shards in steps for y in shards for x in y]
+
+
+def test_load_resumes_after_a_failure(monkeypatch, tmp_path, api, broker):
+    steps = export_partitions(monkeypatch, tmp_path, 2)
+    messages = [x for shards in steps for y in shards for x in y]
+    # The broker fails within the third shard, the first of the second partition
+    first_shards = len(steps[0][0]) + len(steps[0][1])
+    broker.fail_after = first_shards + 5
+    with pytest.raises(ValueError):
+        load_shards()
+    assert broker.messages == messages[: first_shards + 5]
+    broker.fail_after = None
+    load_shards()
+    # The messages of the shard not confirmed are sent again
+    assert broker.messages == messages[: first_shards + 5] + messages[first_shards:]
@@ -0,0 +1,14 @@
+import json
+
+import migrate
+
+
+def test_state_file_is_only_resumed_by_the_main_run(tmp_path, api, broker):
+    state = {"step": 3, "after": "100", "number": 100}
+    (tmp_path / "state.json").write_text(json.dumps(state))
+    # The profile does not publish, it has its own state
+    assert migrate.Migrate(profile=True).get_state()["step"] is None
+    migration = migrate.Migrate()
+    assert migration.get_state() == state
+    assert (tmp_path / "state.json.bak").is_file()
+    migration._close()
@@ -0,0 +1,59 @@
+import time
+
+import migrate
+
+
+def migrate_step_1(monkeypatch, tmp_path, workers):
+    monkeypatch.setenv("OPENCTI_MIGRATION_WORKERS", str(workers))
+    monkeypatch.setattr(migrate, "__file__", str(tmp_path / str(workers) / "x.py"))
+    (tmp_path / str(workers)).mkdir()
+    migration = migrate.Migrate()
+    step, _, list_function, list_arguments, export = migration._steps()[0]
+    started_at = time.monotonic()
+    migration._migrate_step(
+        {"step": step, "after": None, "number": 0},
+        step,
+        list_function,
+        list_arguments,
+        export,
+    )
+    migration._close()
+    return time.monotonic() - started_at
+
+
+def test_entities_are_exported_in_parallel(monkeypatch, tmp_path, api, broker):
+    # Each entity is read with its own query
+    monkeypatch.setenv("OPENCTI_MIGRATION_BULK_EXPORT", "false")
+    api.latency = 0.02
+    durations = {}
+    objects = {}
+    for workers in [1, 8]:
+        broker.messages = []
+        api.max_concurrency = 0
+        durations[workers] = migrate_step_1(monkeypatch, tmp_path, workers)
+        objects[workers] = sorted(x["id"] for x in broker.objects())
+        assert api.max_concurrency == workers
+    assert objects[1] == objects[8]
+    # 30 entities exported one by one, then 8 at a time
+    assert (
+        len([x for x in objects[1] if not x.startswith(("identity", "marking"))]) == 30
+    )
+    assert durations[8] < durations[1] / 3
+
+
+def test_bundles_are_sent_in_the_order_of_the_page(monkeypatch, tmp_path, api, broker):
+    monkeypatch.setenv("OPENCTI_MIGRATION_BULK_EXPORT", "false")
+    monkeypatch.setenv("OPENCTI_MIGRATION_BUNDLE_MAX_OBJECTS", "1")
+    api.latency = 0.005
+    migrate_step_1(monkeypatch, tmp_path, 8)
+    entity_ids = [
+        x["id"]
+        for x in broker.objects()
+        if not x["id"].startswith(("identity", "marking"))
+    ]
+    expected_ids = [
+        x["stix_id_key"]
+        for x in sorted(api.stix_domain_entities, key=lambda x: x["created_at"])
+        if x["entity_type"] not in ["report", "note"]
+    ]
+    assert entity_ids == expected_ids